@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+    asyncio interface of chflasher.py
+    Every device gets one I/O thread that runs its blocking USB transfers, the
+    event loop only waits for the result, so one loop drives many devices next
+    to the rest of a station controller. Operations can be awaited with a
+    timeout, cancelled (the device stops at the next packet) and iterated for
+    progress events.
+
+        async with AsyncFlasher() as dev:
+            op = dev.write('blink.bin', timeout=30)
+            async for event in op:
+                print(event.phase, event.done, event.total)
+            await op
+"""
+
+import asyncio
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+from chflasher import CHflasher, Cancelled, find_usb_transports
+
+ProgressEvent = namedtuple('ProgressEvent', 'operation phase done total time')
+
+
+class Operation:
+    """
+    One running CHflasher operation.
+    await it for the result, async for over it for the ProgressEvents until it ends,
+    cancel() stops it, the device stops at the next packet and stays in the bootloader.
+    """
+
+    def __init__(self, device, name, method, args, timeout=None):
+        self.device = device
+        self.name = name
+        self.cancel_event = threading.Event()
+        self.events = asyncio.Queue()
+        self.task = asyncio.ensure_future(self.__run(method, args, timeout))
+
+    def __progress(self, loop):
+        step = self.device.progress_step
+
+        # runs on the I/O thread, only every step-th packet and the last one are passed to the loop
+        def progress(phase, done, total):
+            if done % step == 0 or done == total or total is None:
+                loop.call_soon_threadsafe(self.events.put_nowait,
+                                          ProgressEvent(self.name, phase, done, total, monotonic()))
+        return progress
+
+    def __call(self, method, args, progress):
+        flash = self.device.flash
+        if self.cancel_event.is_set():
+            raise Cancelled('Cancelled')
+        flash.progress = progress
+        flash.cancel = self.cancel_event
+        try:
+            return method(*args)
+        finally:
+            flash.progress = None
+            flash.cancel = None
+
+    async def __run(self, method, args, timeout):
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.device.executor, self.__call, method, args, self.__progress(loop))
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            # the I/O thread can not be interrupted, it stops at the next packet
+            self.cancel_event.set()
+            await asyncio.gather(future, return_exceptions=True)
+            raise
+        finally:
+            self.events.put_nowait(None)
+
+    def cancel(self):
+        self.task.cancel()
+
+    def done(self):
+        return self.task.done()
+
+    def __await__(self):
+        return self.task.__await__()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        event = await self.events.get()
+        if event is None:
+            # the end marker stays for further iterators
+            self.events.put_nowait(None)
+            raise StopAsyncIteration
+        return event
+
+
+class AsyncFlasher:
+    """
+    asyncio front end of one CHflasher session.
+
+    transport       as for CHflasher, None = the first CH55x on the bus, opened on the I/O thread
+    settings        CHflasher attributes of the session (window, sparse, fused, auto_start ...)
+
+    Operations are queued on the device's I/O thread and run one after another,
+    each returns an Operation, timeout in seconds, None = no limit.
+    """
+
+    # packets between two progress events
+    progress_step = 16
+
+    def __init__(self, transport=None, **settings):
+        self.flash = CHflasher(transport)
+        self.flash.tag = getattr(transport, 'location', None)
+        for name, value in settings.items():
+            setattr(self.flash, name, value)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ch55x')
+
+    @property
+    def location(self):
+        return getattr(self.flash.transport, 'location', None)
+
+    def open(self, timeout=None):
+        return Operation(self, 'open', self.flash.open, (), timeout)
+
+    def detect(self, timeout=None):
+        return Operation(self, 'detect', self.flash.detect, (), timeout)
+
+    def erase(self, firmware=None, timeout=None):
+        return Operation(self, 'erase', self.flash.erase, (firmware,), timeout)
+
+    def write(self, firmware, timeout=None):
+        return Operation(self, 'write', self.flash.write, (firmware,), timeout)
+
+    def verify(self, firmware, timeout=None):
+        return Operation(self, 'verify', self.flash.verify, (firmware,), timeout)
+
+    def verify_ranges(self, firmware, ranges, keep_going=False, timeout=None):
+        return Operation(self, 'verify_ranges', self.flash.verify_ranges, (firmware, ranges, keep_going), timeout)
+
+    def start_app(self, timeout=None):
+        return Operation(self, 'start_app', self.flash.start_app, (), timeout)
+
+    async def close(self):
+        """ closes the session after the queued operations and ends the I/O thread """
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.flash.close)
+        self.executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, tb):
+        await self.close()
+        return False
+
+
+def usb_flashers(**settings):
+    """ an AsyncFlasher for every CH55x bootloader on the bus """
+    return [AsyncFlasher(transport, **settings) for transport in find_usb_transports()]
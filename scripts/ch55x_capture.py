@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""
+    Low overhead USB capture for chflasher.py and offline log renderer.
+    Frames are appended with their timestamp to a preallocated buffer and
+    flushed as a pcap file (Linux usbmon link type, opens in Wireshark).
+    Running this script renders a capture into the chflasher text log layout.
+"""
+
+import sys
+import struct
+import threading
+import time
+import argparse
+from time import localtime, strftime
+
+LINKTYPE_USB_LINUX = 189
+# bulk endpoints of the CH55x bootloader
+EP_OUT = 0x02
+EP_IN = 0x82
+
+PCAP_HEADER = struct.Struct('<IHHiIII')
+RECORD_HEADER = struct.Struct('<IIII')
+# usbmon packet header: id, type, transfer type, endpoint, device, bus, setup flag, data flag,
+# seconds, microseconds, status, length, captured length, setup bytes
+USB_HEADER = struct.Struct('<QBBBBHbbqiiII8s')
+# usbmon status of a timed out transfer (-ETIMEDOUT), recorded as an IN frame without data
+STATUS_TIMEOUT = -110
+
+txt_sep = '---------------------------------------------------------------------------------'
+
+example_text = '''--------------------------------------------------------------------------------
+Example:
+
+ capture while flashing, no text formatting is done during the transfer:
+
+ python3 chflasher.py --capture usb.pcap -w -f blink.bin
+
+ render the capture into the usual text log:
+
+ python3 ch55x_capture.py -i usb.pcap -o usb.log
+'''
+
+
+class CaptureWriter:
+    """ appends timestamped tx/rx frames to a preallocated buffer, written out when full or closed """
+
+    def __init__(self, file_name, buffer_size=1 << 20):
+        self.file = open(file_name, 'wb')
+        self.file.write(PCAP_HEADER.pack(0xa1b2c3d4, 2, 4, 0, 0, 0xffff, LINKTYPE_USB_LINUX))
+        self.buf = bytearray(buffer_size)
+        self.pos = 0
+        self.urb_id = 0
+        self.lock = threading.Lock()
+
+    def record(self, endpoint, data, status=0):
+        t = time.time()
+        length = len(data)
+        size = RECORD_HEADER.size + USB_HEADER.size + length
+        with self.lock:
+            if self.pos + size > len(self.buf):
+                self.flush()
+                if size > len(self.buf):
+                    self.buf = bytearray(size)
+            sec = int(t)
+            usec = int((t - sec) * 1000000)
+            self.urb_id += 1
+            pos = self.pos
+            RECORD_HEADER.pack_into(self.buf, pos, sec, usec, USB_HEADER.size + length, USB_HEADER.size + length)
+            pos += RECORD_HEADER.size
+            USB_HEADER.pack_into(self.buf, pos, self.urb_id, 0x53 if endpoint == EP_OUT else 0x43, 3, endpoint,
+                                 1, 1, 0x2d, 0, sec, usec, status, length, length, bytes(8))
+            pos += USB_HEADER.size
+            self.buf[pos:pos + length] = data
+            self.pos = pos + length
+
+    def flush(self):
+        self.file.write(memoryview(self.buf)[:self.pos])
+        self.pos = 0
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.flush()
+                self.file.close()
+                self.file = None
+
+
+class CaptureTransport:
+    """ passes all transfers to transport and records them with writer """
+
+    def __init__(self, transport, writer):
+        self.transport = transport
+        self.writer = writer
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
+    # a frame is recorded once it was written, timed out OUT transfers never reached the device
+    def write(self, data, timeout=None):
+        result = self.transport.write(data, timeout)
+        self.writer.record(EP_OUT, data)
+        return result
+
+    # commands the bootloader does not answer, recorded as any other OUT frame
+    def write_unanswered(self, data, timeout=None):
+        result = getattr(self.transport, 'write_unanswered', self.transport.write)(data, timeout)
+        self.writer.record(EP_OUT, data)
+        return result
+
+    # a read that timed out is recorded as an empty IN frame, the renderer drops the packet it was waiting for
+    def read(self, size, timeout=None):
+        try:
+            data = self.transport.read(size, timeout)
+        except TimeoutError:
+            self.writer.record(EP_IN, b'', STATUS_TIMEOUT)
+            raise
+        self.writer.record(EP_IN, data)
+        return data
+
+    def close(self):
+        self.transport.close()
+
+
+def read_capture(file_name):
+    """ yields (timestamp, endpoint, data) of every frame in a capture written by CaptureWriter """
+    with open(file_name, 'rb') as f:
+        header = f.read(PCAP_HEADER.size)
+        magic, _, _, _, _, _, linktype = PCAP_HEADER.unpack(header)
+        if magic != 0xa1b2c3d4 or linktype != LINKTYPE_USB_LINUX:
+            raise ValueError(file_name + ' is not a chflasher capture')
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                break
+            sec, usec, incl_len, _ = RECORD_HEADER.unpack(header)
+            record = f.read(incl_len)
+            endpoint = record[10]
+            yield sec + usec / 1000000.0, endpoint, record[USB_HEADER.size:]
+
+
+def __hex(data):
+    return ':'.join('{:02x}'.format(x) for x in data)
+
+
+def __print_buffers(tx, rx, out):
+    length = max(len(tx), len(rx))
+    print("add= " + '|'.join('{:02x}'.format(x) for x in range(length)), file=out)
+    if len(tx):
+        print("tx = " + __hex(tx), file=out)
+    if len(rx):
+        print("rx = " + __hex(rx), file=out)
+
+
+def __print_buffer_errors(tx, rx, out):
+    address = tx[3] | (tx[4] << 8)
+    msg = "ERR" if rx[4] != 0x00 else "OK "
+    print('0x{:>04x}'.format(address) + ":" + msg + '|{:>02x}|'.format(rx[4]) + __hex(tx), file=out)
+
+
+def __transactions(records):
+    # pairs every OUT frame with its reply, the exit bootloader command is not answered,
+    # an empty IN frame is a timed out read: the oldest unanswered packet is yielded with reply None,
+    # the reads up to the next OUT frame drain the late replies of packets sent again, as chflasher
+    # drops them they are not yielded
+    pending = []
+    draining = False
+    for _, endpoint, data in records:
+        if endpoint == EP_OUT:
+            draining = False
+            if (data[0] == 0xa5 and len(data) < 8) or (data[0] == 0xa2 and len(data) == 4):
+                yield data, b''
+            else:
+                pending.append(data)
+        elif pending:
+            tx = pending.pop(0)
+            if not draining:
+                yield tx, data if len(data) else None
+            draining = draining or not len(data)
+
+
+def render_log(records, out):
+    """ writes the transfers in the layout of the chflasher --log file """
+    records = list(records)
+    if records:
+        print(txt_sep, file=out)
+        print(strftime("%a, %d %b %Y %X +0000", localtime(records[0][0])), file=out)
+        print(txt_sep, file=out, end="\r\n")
+    transactions = list(__transactions(records))
+    # image size: end of the highest written or verified chunk
+    size = 0
+    for tx, rx in transactions:
+        if rx is not None and tx[0] in (0xa5, 0xa6) and len(tx) >= 8:
+            size = max(size, (tx[3] | (tx[4] << 8)) + tx[1] - 5)
+    detected = False
+    chipid = 0
+    section = None
+    timed_out = None
+    retry = 0
+    for tx, rx in transactions:
+        cmd = tx[0]
+        if rx is None:
+            # the packet is sent again, count the retries of the same packet as --log does
+            retry = retry + 1 if tx == timed_out else 1
+            timed_out = tx
+            print("USB timeout, command " + '0x{:02x}'.format(cmd) + ", retry " + str(retry), file=out)
+            continue
+        timed_out = None
+        if cmd == 0xa1 and len(rx) == 6:
+            chipid = rx[4]
+        if cmd in (0xa5, 0xa6) and len(tx) >= 8:
+            if section != cmd:
+                section = cmd
+                print(txt_sep, file=out)
+                if cmd == 0xa5:
+                    print("Writing " + str(size) + " bytes to Flash.", file=out)
+                else:
+                    print("Veryfing " + str(size) + " bytes of Flash.", file=out)
+                print("add=          " + '|'.join('{:02x}'.format(x) for x in range(64)), file=out)
+            if len(rx) > 4:
+                __print_buffer_errors(tx, rx, out)
+            continue
+        section = None
+        if cmd == 0xa1 and not detected:
+            detected = True
+            print("Detecting bootloader version:", file=out)
+        elif cmd == 0xa1:
+            print(txt_sep, file=out)
+            print("Chip identification:", file=out)
+        elif cmd == 0xa7:
+            print(txt_sep, file=out)
+            print("Config read:", file=out)
+        elif cmd == 0xa3:
+            print(txt_sep, file=out)
+            print("Key input:", file=out)
+            print("Checksum: " + str(hex(tx[3])), file=out)
+            print("Xorer: " + str(hex((tx[3] + 0x52) % 256)), file=out)
+            print("ChipID = " + str(hex(chipid)), file=out)
+        elif cmd == 0xa4:
+            print(txt_sep, file=out)
+            print("Erasing flash:", file=out)
+        elif not rx:
+            print(txt_sep, file=out)
+            print("Starting application:", file=out)
+        else:
+            print(txt_sep, file=out)
+            print("Command 0x{:02x}:".format(cmd), file=out)
+        __print_buffers(tx, rx, out)
+
+
+def __main(argv):
+    parser = argparse.ArgumentParser(description="Render a chflasher USB capture as a text log.",
+                                     epilog=example_text,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-i', '--input', type=str, required=True, help="Capture file written with --capture.")
+    parser.add_argument('-o', '--output', type=str, required=True, help="Text log file.")
+    args = parser.parse_args(argv)
+
+    with open(args.output, 'w') as out_file:
+        render_log(read_capture(args.input), out_file)
+    print("Log file saved: " + args.output)
+
+
+if __name__ == "__main__":
+    __main(sys.argv[1:])
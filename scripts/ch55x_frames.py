@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+    Frame encoder for the CH55x bootloader write/verify packets.
+    The whole image is turned into its final 64 byte frames in one go, write
+    and verify passes share the same buffer and differ only in the mode byte.
+    Images are either one buffer or a list of (address, data) segments, frames
+    never cross a segment boundary and the gaps are not sent.
+"""
+
+from bisect import bisect_right
+
+FRAME_SIZE = 64
+# payload bytes per frame
+CHUNK_V1 = 0x3c
+CHUNK_V2 = 0x38
+
+
+class FrameStream:
+    """
+    Pre-encoded write/verify frames of one image.
+
+    buf         all frames back to back, FRAME_SIZE bytes each
+    addrs       flash address of every frame
+    lengths     payload length of every frame
+    size        image size in bytes, end address of the last frame
+    chunks      plain payload of every frame, memoryview slices of the image
+    indices     frames sent by this stream, None = all of them
+    offset      position of the payload in a frame
+    key         xor of every 8th frame byte, 0 = not scrambled
+    """
+
+    def __init__(self, buf, addrs, lengths, size, chunks, indices=None, offset=FRAME_SIZE - CHUNK_V2, key=0):
+        self.buf = buf
+        self.addrs = addrs
+        self.lengths = lengths
+        self.size = size
+        self.chunks = chunks
+        self.indices = indices
+        self.offset = offset
+        self.key = key
+        self.view = memoryview(buf)
+
+    def __len__(self):
+        if self.indices is None:
+            return len(self.addrs)
+        return len(self.indices)
+
+    def set_mode(self, mode):
+        """ mode byte of the frames of this stream, a subset leaves the other frames alone """
+        if self.indices is None:
+            self.buf[0::FRAME_SIZE] = bytes([mode]) * len(self.addrs)
+        else:
+            for index in self.indices:
+                self.buf[index * FRAME_SIZE] = mode
+
+    def frame(self, index):
+        return self.view[index * FRAME_SIZE:(index + 1) * FRAME_SIZE]
+
+    def __iter__(self):
+        indices = range(len(self.addrs)) if self.indices is None else self.indices
+        for index in indices:
+            yield self.addrs[index], self.lengths[index], self.view[index * FRAME_SIZE:(index + 1) * FRAME_SIZE]
+
+    def copy(self):
+        """ stream with its own frame buffer, so parallel sessions can set their own mode byte """
+        return FrameStream(bytearray(self.buf), self.addrs, self.lengths, self.size, self.chunks, self.indices,
+                           self.offset, self.key)
+
+    def patched(self, patches):
+        """
+        copy of the stream with byte patches [(address, data)] applied over the image,
+        only the payload of the frames holding patched bytes is encoded again
+        """
+        stream = self.copy()
+        stream.chunks = list(self.chunks)
+        table = bytes(x ^ self.key for x in range(256))
+        for addr, data in patches:
+            pos = 0
+            while pos < len(data):
+                index = bisect_right(self.addrs, addr + pos) - 1
+                if index < 0 or addr + pos >= self.addrs[index] + self.lengths[index]:
+                    raise ValueError('patch address 0x{:04x} is not in the image'.format(addr + pos))
+                start = addr + pos - self.addrs[index]
+                length = min(len(data) - pos, self.lengths[index] - start)
+                chunk = bytearray(stream.chunks[index])
+                chunk[start:start + length] = data[pos:pos + length]
+                stream.chunks[index] = memoryview(chunk)
+                # payload and scrambling of this frame only, frames start on a multiple of 8
+                first = index * FRAME_SIZE + self.offset
+                payload = bytearray(chunk)
+                if self.key:
+                    skip = (7 - self.offset) % 8
+                    payload[skip::8] = payload[skip::8].translate(table)
+                stream.buf[first:first + len(payload)] = payload
+                pos += length
+        return stream
+
+    def subset(self, indices):
+        """ stream of the given frames only, sharing the encoded buffer """
+        return FrameStream(self.buf, self.addrs, self.lengths, self.size, self.chunks, list(indices),
+                           self.offset, self.key)
+
+    def blocks(self, block):
+        """
+        the stream split into consecutive subsets
+        block: frames per subset, 0 = one subset per 1 KiB erase sector
+        """
+        groups = {}
+        indices = range(len(self.addrs)) if self.indices is None else self.indices
+        for i in indices:
+            key = self.addrs[i] // 1024 if not block else i // block
+            groups.setdefault(key, []).append(i)
+        return {key: self.subset(group) for key, group in groups.items()}
+
+    def blank_frames(self, erased_value):
+        """ indices of the frames whose payload already equals erased flash """
+        blank = bytes([erased_value]) * max(CHUNK_V1, CHUNK_V2)
+        indices = range(len(self.addrs)) if self.indices is None else self.indices
+        return [i for i in indices if self.chunks[i] == blank[:self.lengths[i]]]
+
+    def ranges(self, ranges):
+        """ stream of the frames overlapping any of the (start, stop) address ranges, stop exclusive """
+        indices = range(len(self.addrs)) if self.indices is None else self.indices
+        return self.subset(i for i in indices
+                           if any(self.addrs[i] < stop and self.addrs[i] + self.lengths[i] > start
+                                  for start, stop in ranges))
+
+    def sparse(self, erased_value):
+        """ stream without the frames that already match erased flash """
+        blank = set(self.blank_frames(erased_value))
+        indices = range(len(self.addrs)) if self.indices is None else self.indices
+        return self.subset(i for i in indices if i not in blank)
+
+
+class FaultMap:
+    """
+    Failing frames of a verify pass.
+    Kept as a bitmap with one bit per chunk of flash and as a run-length
+    list of (start, stop) address ranges, adjacent failing frames are merged.
+    """
+
+    def __init__(self, chunk):
+        self.chunk = chunk
+        self.bitmap = bytearray()
+        self.runs = []
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, addr, length):
+        self.count += 1
+        index = addr // self.chunk
+        if index // 8 >= len(self.bitmap):
+            self.bitmap.extend(bytes(index // 8 + 1 - len(self.bitmap)))
+        self.bitmap[index // 8] |= 1 << (index % 8)
+        if self.runs and self.runs[-1][1] == addr:
+            self.runs[-1] = (self.runs[-1][0], addr + length)
+        else:
+            self.runs.append((addr, addr + length))
+
+    def __str__(self):
+        return ', '.join('0x{:04x}-0x{:04x}'.format(start, stop - 1) for start, stop in self.runs)
+
+
+def __segments(data, base):
+    if isinstance(data, list):
+        return sorted(data, key=lambda s: s[0])
+    return [(base, data)]
+
+
+def __layout(segments, chunk):
+    addrs = []
+    chunks = []
+    for seg_addr, seg_data in segments:
+        src = memoryview(seg_data)
+        for offset in range(0, len(src), chunk):
+            addrs.append(seg_addr + offset)
+            chunks.append(src[offset:offset + chunk])
+    lengths = [len(c) for c in chunks]
+    buf = bytearray(FRAME_SIZE * len(addrs))
+    for index, src in enumerate(chunks):
+        offset = index * FRAME_SIZE + FRAME_SIZE - chunk
+        buf[offset:offset + lengths[index]] = src
+    size = addrs[-1] + lengths[-1] if addrs else 0
+    return buf, addrs, lengths, chunks, size
+
+
+def encode_v1(data, mode=0, base=0):
+    """
+    frames for the v1.1 bootloader: mode, length, address, 60 bytes of plain payload
+    data: image starting at base, or a list of (address, data) segments
+    """
+    buf, addrs, lengths, chunks, size = __layout(__segments(data, base), CHUNK_V1)
+    buf[0::FRAME_SIZE] = bytes([mode]) * len(addrs)
+    buf[1::FRAME_SIZE] = bytes(lengths)
+    buf[2::FRAME_SIZE] = bytes(a & 0xff for a in addrs)
+    buf[3::FRAME_SIZE] = bytes((a >> 8) & 0xff for a in addrs)
+    return FrameStream(buf, addrs, lengths, size, chunks, offset=FRAME_SIZE - CHUNK_V1)
+
+
+def encode_v2(data, chipid, mode=0, base=0):
+    """
+    frames for the v2.3 bootloader:
+    mode, length + 5, 0, address, 0, 0, remaining bytes & 0xff, 56 bytes of payload
+    every 8th byte of the used part of a frame is xored with the chip id
+    data: image starting at base, or a list of (address, data) segments
+    """
+    buf, addrs, lengths, chunks, size = __layout(__segments(data, base), CHUNK_V2)
+    buf[0::FRAME_SIZE] = bytes([mode]) * len(addrs)
+    buf[1::FRAME_SIZE] = bytes(x + 5 for x in lengths)
+    buf[3::FRAME_SIZE] = bytes(a & 0xff for a in addrs)
+    buf[4::FRAME_SIZE] = bytes((a >> 8) & 0xff for a in addrs)
+    buf[7::FRAME_SIZE] = bytes((size - a) & 0xff for a in addrs)
+    buf[7::8] = buf[7::8].translate(bytes(x ^ chipid for x in range(256)))
+    # the unused tail of a short frame is sent as zeros, not scrambled
+    for index, length in enumerate(lengths):
+        if length != CHUNK_V2:
+            tail = index * FRAME_SIZE + length + 8
+            buf[tail:(index + 1) * FRAME_SIZE] = bytes((index + 1) * FRAME_SIZE - tail)
+    return FrameStream(buf, addrs, lengths, size, chunks, key=chipid)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+    Firmware image loader for chflasher.py
+    .bin files are memory mapped and handed out as memoryview slices, Intel HEX
+    files (the .ihx sdcc writes) are parsed into sparse segments, so the gaps
+    between them are never sent to the bootloader.
+    Per unit byte patches (serial numbers, calibration) are read from
+    OFFSET=HEX strings or a csv file with one row per unit.
+"""
+
+import os
+import csv
+import mmap
+
+
+class ImageError(Exception):
+    pass
+
+
+class FirmwareImage:
+    """
+    Firmware image as a list of segments.
+
+    name        file the image was loaded from
+    segments    sorted, non overlapping (address, memoryview) pairs
+    size        extent of the image: end address of the last segment
+    frames      encoded frames {(bootloader, chipid): FrameStream}, filled by chflasher.py
+    """
+
+    def __init__(self, name, segments):
+        self.name = name
+        self.segments = sorted(segments, key=lambda s: s[0])
+        self.size = self.segments[-1][0] + len(self.segments[-1][1]) if self.segments else 0
+        self.frames = {}
+
+    def __len__(self):
+        """ number of bytes in all segments """
+        return sum(len(data) for _, data in self.segments)
+
+    def flat(self, fill=0xff):
+        """ the whole image as one buffer, the gaps filled with fill """
+        if len(self.segments) == 1 and self.segments[0][0] == 0:
+            return self.segments[0][1]
+        buf = bytearray([fill]) * self.size
+        for addr, data in self.segments:
+            buf[addr:addr + len(data)] = data
+        return memoryview(buf)
+
+
+def __load_bin(file_name):
+    with open(file_name, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return FirmwareImage(file_name, [])
+        # the map stays open as long as a view of it is alive
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return FirmwareImage(file_name, [(0, memoryview(data))])
+
+
+def parse_ihx(lines, name='ihx'):
+    """ Intel HEX records to a FirmwareImage, contiguous data records are merged into one segment """
+    segments = []
+    base = 0
+    start = None
+    buf = bytearray()
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        if not line.startswith(':'):
+            raise ImageError('{}:{}: not an Intel HEX record'.format(name, number))
+        try:
+            record = bytes.fromhex(line[1:])
+        except ValueError:
+            raise ImageError('{}:{}: not an Intel HEX record'.format(name, number))
+        if len(record) < 5 or len(record) != record[0] + 5:
+            raise ImageError('{}:{}: wrong record length'.format(name, number))
+        if sum(record) & 0xff:
+            raise ImageError('{}:{}: checksum error'.format(name, number))
+        rec_type = record[3]
+        payload = record[4:-1]
+        if rec_type == 0x00:
+            addr = base + ((record[1] << 8) | record[2])
+            if start is not None and addr == start + len(buf):
+                buf += payload
+            else:
+                if start is not None and buf:
+                    segments.append((start, buf))
+                start = addr
+                buf = bytearray(payload)
+        elif rec_type == 0x01:
+            break
+        elif rec_type == 0x02:
+            base = int.from_bytes(payload, 'big') << 4
+        elif rec_type == 0x04:
+            base = int.from_bytes(payload, 'big') << 16
+        # 0x03 and 0x05 only hold the start address
+    if start is not None and buf:
+        segments.append((start, buf))
+    segments.sort(key=lambda s: s[0])
+    for (addr, data), (next_addr, _) in zip(segments, segments[1:]):
+        if addr + len(data) > next_addr:
+            raise ImageError('{}: overlapping data at 0x{:04x}'.format(name, next_addr))
+    return FirmwareImage(name, [(addr, memoryview(data)) for addr, data in segments])
+
+
+def load_image(file_name):
+    """ FirmwareImage of a .bin or Intel HEX (.ihx, .hex) file """
+    if os.path.splitext(file_name)[1].lower() in ('.ihx', '.hex'):
+        with open(file_name, 'r') as f:
+            return parse_ihx(f, file_name)
+    return __load_bin(file_name)
+
+
+def parse_patch(txt):
+    """ OFFSET=HEX, e.g. 0x3ff0=00:00:12:34, to (address, bytes) """
+    offset, _, value = txt.partition('=')
+    try:
+        addr = int(offset, 0)
+        data = bytes.fromhex(value.replace(':', ''))
+    except ValueError:
+        raise ImageError('patch must be OFFSET=HEX, e.g. 0x3ff0=00001234: ' + txt)
+    if addr < 0 or not data:
+        raise ImageError('patch must be OFFSET=HEX, e.g. 0x3ff0=00001234: ' + txt)
+    return addr, data
+
+
+def load_patch_csv(file_name):
+    """
+    Patches of every unit from a csv file: the header holds the offsets, every row
+    the unit name in the first column and the hex bytes written at each offset,
+    empty cells are not patched.
+        unit,0x3ff0,0x3ff8
+        A0001,00000001,5a
+    Returns [(unit, [(address, bytes)])] in file order.
+    """
+    with open(file_name, newline='') as f:
+        rows = [row for row in csv.reader(f) if row]
+    if not rows:
+        raise ImageError(file_name + ': no header')
+    offsets = rows[0][1:]
+    units = []
+    for number, row in enumerate(rows[1:], 2):
+        if len(row) > len(rows[0]):
+            raise ImageError('{}:{}: more cells than offsets'.format(file_name, number))
+        try:
+            patches = [parse_patch(offset + '=' + value.strip()) for offset, value in zip(offsets, row[1:])
+                       if value.strip()]
+        except ImageError as ex:
+            raise ImageError('{}:{}: {}'.format(file_name, number, ex))
+        units.append((row[0].strip(), patches))
+    return units
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+    Timing instrumentation for chflasher.py
+    Phases (usb open, identify, erase, write, verify, ...) are timed with a
+    context manager, every USB round trip through ProfileTransport. Latencies
+    are summarised per command byte (p50/p95/p99/max) and exported as json or
+    in the Prometheus text format. Nothing is recorded when no profiler is set.
+"""
+
+import json
+import math
+import threading
+from collections import deque
+from contextlib import contextmanager
+from time import monotonic
+
+
+def percentile(values, p):
+    """ nearest rank percentile of sorted values """
+    if not values:
+        return 0.0
+    rank = math.ceil(p / 100.0 * len(values))
+    return values[max(0, min(len(values), rank) - 1)]
+
+
+class Profiler:
+    """
+    Timestamps of one flashing session.
+
+    phases      [(name, start, stop)] in the order they ran, monotonic seconds
+    latencies   {command byte: [round trip seconds]}
+    timeouts    {command byte: number of replies that never came}
+    """
+
+    def __init__(self):
+        self.t_start = monotonic()
+        self.phases = []
+        self.latencies = {}
+        self.timeouts = {}
+
+    @contextmanager
+    def phase(self, name):
+        t_start = monotonic()
+        try:
+            yield
+        finally:
+            self.phases.append((name, t_start, monotonic()))
+
+    def record(self, cmd, t_out, t_in):
+        latencies = self.latencies.get(cmd)
+        if latencies is None:
+            latencies = self.latencies[cmd] = []
+        latencies.append(t_in - t_out)
+
+    def record_timeout(self, cmd):
+        self.timeouts[cmd] = self.timeouts.get(cmd, 0) + 1
+
+    def summary(self):
+        """ phase totals and the latency statistics per command, all in seconds """
+        phases = {}
+        for name, t_start, t_stop in self.phases:
+            phases[name] = phases.get(name, 0.0) + t_stop - t_start
+        commands = {}
+        for cmd in sorted(set(self.latencies) | set(self.timeouts)):
+            values = sorted(self.latencies.get(cmd, ()))
+            commands['0x{:02x}'.format(cmd)] = {
+                'count': len(values),
+                'sum': sum(values),
+                'p50': percentile(values, 50),
+                'p95': percentile(values, 95),
+                'p99': percentile(values, 99),
+                'max': values[-1] if values else 0.0,
+                'timeouts': self.timeouts.get(cmd, 0),
+            }
+        return {'total_s': monotonic() - self.t_start, 'phases_s': phases, 'commands': commands}
+
+    def write_json(self, file_name, labels=None):
+        result = self.summary()
+        result['labels'] = labels or {}
+        with open(file_name, 'w') as f:
+            json.dump(result, f, indent=2)
+
+    def write_prometheus(self, file_name, labels=None):
+        summary = self.summary()
+        extra = ''.join(',{}="{}"'.format(k, v) for k, v in sorted((labels or {}).items()))
+        lines = ['# HELP chflasher_phase_seconds Wall time of a flashing phase.',
+                 '# TYPE chflasher_phase_seconds gauge']
+        for name, seconds in summary['phases_s'].items():
+            lines.append('chflasher_phase_seconds{{phase="{}"{}}} {:.6f}'.format(name, extra, seconds))
+        lines += ['# HELP chflasher_command_latency_seconds USB round trip time per bootloader command.',
+                  '# TYPE chflasher_command_latency_seconds summary']
+        for cmd, stats in summary['commands'].items():
+            for q, key in (('0.5', 'p50'), ('0.95', 'p95'), ('0.99', 'p99'), ('1', 'max')):
+                lines.append('chflasher_command_latency_seconds{{command="{}",quantile="{}"{}}} {:.6f}'.format(
+                    cmd, q, extra, stats[key]))
+            lines.append('chflasher_command_latency_seconds_sum{{command="{}"{}}} {:.6f}'.format(
+                cmd, extra, stats['sum']))
+            lines.append('chflasher_command_latency_seconds_count{{command="{}"{}}} {}'.format(
+                cmd, extra, stats['count']))
+        lines += ['# HELP chflasher_command_timeouts_total Replies per bootloader command that timed out.',
+                  '# TYPE chflasher_command_timeouts_total counter']
+        for cmd, stats in summary['commands'].items():
+            lines.append('chflasher_command_timeouts_total{{command="{}"{}}} {}'.format(
+                cmd, extra, stats['timeouts']))
+        with open(file_name, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def write(self, file_name, labels=None):
+        """ .prom files in the Prometheus text format, everything else as json """
+        if file_name.endswith('.prom'):
+            self.write_prometheus(file_name, labels)
+        else:
+            self.write_json(file_name, labels)
+
+    def print_summary(self, out=None):
+        summary = self.summary()
+        print('-' * 81, file=out)
+        print('Profile, total {:.2f} ms'.format(summary['total_s'] * 1000), file=out)
+        for name, seconds in summary['phases_s'].items():
+            print('  {:<10} {:>10.2f} ms'.format(name, seconds * 1000), file=out)
+        print('  {:<6} {:>7} {:>9} {:>9} {:>9} {:>9} {:>8}  (ms)'.format('cmd', 'count', 'p50', 'p95', 'p99', 'max',
+                                                                          'timeouts'), file=out)
+        for cmd, s in summary['commands'].items():
+            print('  {:<6} {:>7} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f} {:>8}'.format(
+                cmd, s['count'], s['p50'] * 1000, s['p95'] * 1000, s['p99'] * 1000, s['max'] * 1000, s['timeouts']),
+                file=out)
+
+
+class ProfileTransport:
+    """ passes all transfers to transport and records the round trip of every packet with profiler """
+
+    def __init__(self, transport, profiler):
+        self.transport = transport
+        self.profiler = profiler
+        # packets written and not answered yet, replies come back in order
+        self.pending = deque()
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
+    # only packets that were written are waiting for a reply, a timed out write leaves no entry
+    def write(self, data, timeout=None):
+        t_out = monotonic()
+        result = self.transport.write(data, timeout)
+        with self.lock:
+            self.pending.append((data[0], t_out))
+        return result
+
+    # commands the bootloader does not answer (leaving the bootloader) are not waiting for a reply
+    def write_unanswered(self, data, timeout=None):
+        return getattr(self.transport, 'write_unanswered', self.transport.write)(data, timeout)
+
+    # a read that timed out ends the round trip of the oldest packet, it is counted as a timeout
+    def read(self, size, timeout=None):
+        try:
+            data = self.transport.read(size, timeout)
+        except TimeoutError:
+            with self.lock:
+                if self.pending:
+                    self.profiler.record_timeout(self.pending.popleft()[0])
+            raise
+        t_in = monotonic()
+        with self.lock:
+            if self.pending:
+                cmd, t_out = self.pending.popleft()
+                self.profiler.record(cmd, t_out, t_in)
+        return data
+
+    def close(self):
+        self.transport.close()
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+    In-process emulator of the CH55x USB bootloader, v1.1 and v2.3 protocol.
+    Keeps an in-memory flash model and can be plugged into CHflasher through
+    SimTransport, so the flasher can be measured and tested without a board.
+"""
+
+import threading
+import time
+import random
+from collections import deque
+
+# erase granularity of the bootloader, the a4 erase command counts 1 KiB sectors
+FLASH_SECTOR = 1024
+
+# code flash size per chip id
+flash_sizes = {
+    0x51: 10 * 1024,
+    0x52: 16 * 1024,
+    0x54: 14 * 1024,
+    0x58: 32 * 1024,
+    0x59: 60 * 1024,
+}
+
+# reply status codes used by the v2.3 bootloader
+STATUS_OK = 0x00
+STATUS_FAIL = 0xf5
+STATUS_UNKNOWN = 0xfe
+
+
+class SimCH55x:
+    """
+    Model of one CH55x sitting in the bootloader.
+
+    chipid              0x51, 0x52, 0x54, 0x58 or 0x59
+    bootloader          '1.1' or '2.3'
+    erased_value        value of an erased flash byte
+    fill                initial flash content, defaults to erased flash
+    fail_verify_from    every verify packet at or above this address replies 0xF5
+    fail_write_from     every write packet at or above this address replies 0xF5
+    packet_time         device side processing time of one packet in seconds
+    sector_erase_time   time needed to erase one 1 KiB sector in seconds
+
+    Flash is programmed the NOR way: writing can only clear bits, so writing
+    over a sector that was not erased leaves the old content mixed in and the
+    following verify fails, the same way a real chip does.
+    """
+
+    def __init__(self, chipid=0x59, bootloader='2.3', erased_value=0xff, fill=None,
+                 fail_verify_from=None, fail_write_from=None,
+                 packet_time=0.0, sector_erase_time=0.0):
+        if chipid not in flash_sizes:
+            raise ValueError('Unsupported chip id 0x{:02x}'.format(chipid))
+        if bootloader not in ('1.1', '2.3'):
+            raise ValueError('Unsupported bootloader version ' + str(bootloader))
+        self.chipid = chipid
+        self.bootloader = bootloader
+        self.erased_value = erased_value
+        self.flash_size = flash_sizes[chipid]
+        if fill is None:
+            fill = erased_value
+        self.flash = bytearray([fill]) * self.flash_size
+        self.fail_verify_from = fail_verify_from
+        self.fail_write_from = fail_write_from
+        self.packet_time = packet_time
+        self.sector_erase_time = sector_erase_time
+        # bytes 22..25 of the config reply are used by the host to build the key
+        self.config = bytes((0xa7, 0xdf, 0x1a, 0x00, 0x1f, 0x00, 0xff, 0xff, 0xff, 0xff,
+                             0x23, 0x00, 0x00, 0x00, 0xff, 0x4e, 0xef, 0xf4, 0x00, 0x02,
+                             0x03, 0x01, 0xb6, 0xd4, 0xa1, 0x58, 0x40, 0x0b, 0xc1, 0xea))
+        self.xor_table = bytes(x ^ chipid for x in range(256))
+        self.key_received = False
+        self.app_started = False
+        self.packets = 0
+        self.cmd_count = {}
+
+    def process(self, pkt):
+        """
+        Handle one OUT packet.
+        Returns (reply, busy) where reply is None for commands without an answer
+        and busy is the simulated device processing time in seconds.
+        """
+        pkt = bytes(pkt)
+        self.packets += 1
+        cmd = pkt[0] if len(pkt) else None
+        self.cmd_count[cmd] = self.cmd_count.get(cmd, 0) + 1
+        if self.bootloader == '2.3':
+            return self.__process_v2(cmd, pkt)
+        return self.__process_v1(cmd, pkt)
+
+    def __reply_v2(self, cmd, status):
+        return bytes((cmd, 0xdf, 0x02, 0x00, status, 0x00))
+
+    def __process_v2(self, cmd, pkt):
+        busy = self.packet_time
+        if cmd == 0xa1:
+            return bytes((0xa1, 0xdf, 0x02, 0x00, self.chipid, 0x11)), busy
+        if cmd == 0xa7:
+            return self.config, busy
+        if cmd == 0xa3:
+            self.key_received = True
+            return self.__reply_v2(cmd, STATUS_OK), busy
+        if cmd == 0xa4:
+            sectors = pkt[3]
+            self.__erase(0, sectors * FLASH_SECTOR)
+            return self.__reply_v2(cmd, STATUS_OK), busy + sectors * self.sector_erase_time
+        if cmd == 0xa2 or (cmd == 0xa5 and len(pkt) < 8):
+            # chflasher exits the v2.3 bootloader with the v1.1 sequence a5:02:01:00
+            self.app_started = True
+            return None, busy
+        if cmd in (0xa5, 0xa6):
+            length = pkt[1] - 5
+            addr = pkt[3] | (pkt[4] << 8)
+            frame = bytearray(pkt[:length + 8])
+            frame[7::8] = frame[7::8].translate(self.xor_table)
+            payload = bytes(frame[8:])
+            if cmd == 0xa5:
+                status = self.__program(addr, payload, self.fail_write_from)
+            else:
+                status = self.__compare(addr, payload, self.fail_verify_from)
+            return self.__reply_v2(cmd, status), busy
+        return self.__reply_v2(cmd, STATUS_UNKNOWN), busy
+
+    def __process_v1(self, cmd, pkt):
+        busy = self.packet_time
+        if cmd == 0xa1:
+            # v2.3 detect sequence, a v1.1 bootloader answers with 2 bytes only
+            return bytes((0x00, 0x00)), busy
+        if cmd == 0xa2:
+            return bytes((self.chipid, 0x11)), busy
+        if cmd == 0xbb:
+            return bytes((0x11, 0x00)), busy
+        if cmd == 0xa6:
+            return bytes((0x00, 0x00)), busy
+        if cmd == 0xa9:
+            start = (pkt[3] // 4) * FLASH_SECTOR
+            self.__erase(start, start + FLASH_SECTOR)
+            return bytes((0x00, 0x00)), busy + self.sector_erase_time
+        if cmd == 0xa5:
+            self.app_started = True
+            return None, busy
+        if cmd in (0xa8, 0xa7):
+            length = pkt[1]
+            addr = pkt[2] | (pkt[3] << 8)
+            payload = pkt[4:4 + length]
+            if cmd == 0xa8:
+                status = self.__program(addr, payload, self.fail_write_from)
+            else:
+                status = self.__compare(addr, payload, self.fail_verify_from)
+            return bytes((status, 0x00)), busy
+        return bytes((STATUS_UNKNOWN, 0x00)), busy
+
+    def __erase(self, start, stop):
+        stop = min(stop, self.flash_size)
+        if stop > start:
+            self.flash[start:stop] = bytes([self.erased_value]) * (stop - start)
+
+    def __program(self, addr, payload, fail_from):
+        if addr + len(payload) > self.flash_size:
+            return STATUS_FAIL
+        if fail_from is not None and addr >= fail_from:
+            return STATUS_FAIL
+        old = int.from_bytes(self.flash[addr:addr + len(payload)], 'little')
+        new = old & int.from_bytes(payload, 'little')
+        self.flash[addr:addr + len(payload)] = new.to_bytes(len(payload), 'little')
+        return STATUS_OK
+
+    def __compare(self, addr, payload, fail_from):
+        if addr + len(payload) > self.flash_size:
+            return STATUS_FAIL
+        if fail_from is not None and addr >= fail_from:
+            return STATUS_FAIL
+        if self.flash[addr:addr + len(payload)] != payload:
+            return STATUS_FAIL
+        return STATUS_OK
+
+
+class SimTransport:
+    """
+    CHflasher transport talking to a SimCH55x.
+
+    latency     host <-> device turnaround of one transfer in seconds, this part
+                overlaps when several packets are in flight
+    location    name reported in place of the USB bus/port
+    read_timeout default read timeout in seconds, the timeout argument of read() is in ms
+    stall_packets   numbers of the OUT transfers (1 = first) that stall: the packet does not
+                reach the device and write() raises TimeoutError after the timeout
+    stall_rate      probability of a stall for any transfer, seeded with seed
+    drop_replies    numbers of the OUT transfers (1 = first) whose reply is lost: the device
+                processes the packet but the read of its reply times out
+    The device processes packets one after another, so replies never become
+    ready faster than its own packet_time allows.
+    Every transfer is recorded in self.trace as (t_out, t_in, cmd, out_len),
+    t_in stays None for commands the bootloader does not answer, stalled transfers are not recorded.
+    """
+
+    def __init__(self, device, latency=0.0, read_timeout=1.0, location='sim',
+                 stall_packets=None, stall_rate=0.0, seed=None, drop_replies=None):
+        self.device = device
+        self.location = location
+        self.latency = latency
+        self.read_timeout = read_timeout
+        self.stall_packets = set(stall_packets or ())
+        self.stall_rate = stall_rate
+        self.drop_replies = set(drop_replies or ())
+        self.stalls = 0
+        self.trace = []
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.__random = random.Random(seed)
+        self.__transfers = 0
+        self.__replies = deque()
+        self.__cv = threading.Condition()
+        self.__ready = 0.0
+
+    def write(self, data, timeout=None):
+        with self.__cv:
+            self.__transfers += 1
+            stalled = self.__transfers in self.stall_packets or \
+                (self.stall_rate and self.__random.random() < self.stall_rate)
+            if stalled:
+                self.stalls += 1
+        if stalled:
+            time.sleep(self.read_timeout if timeout is None else timeout / 1000.0)
+            raise TimeoutError('Operation timed out')
+        now = time.monotonic()
+        reply, busy = self.device.process(data)
+        with self.__cv:
+            self.bytes_out += len(data)
+            self.__ready = max(now + self.latency, self.__ready) + busy
+            cmd = data[0] if len(data) else None
+            if reply is not None and self.__transfers not in self.drop_replies:
+                self.__replies.append((self.__ready, reply, len(self.trace)))
+            self.trace.append((now, None, cmd, len(data)))
+            self.__cv.notify()
+        return len(data)
+
+    def read(self, size, timeout=None):
+        wait = self.read_timeout if timeout is None else timeout / 1000.0
+        with self.__cv:
+            if not self.__replies:
+                self.__cv.wait_for(lambda: len(self.__replies) > 0, wait)
+            if not self.__replies:
+                raise TimeoutError('Operation timed out')
+            ready, reply, idx = self.__replies.popleft()
+        delay = ready - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        t_in = time.monotonic()
+        with self.__cv:
+            t_out, _, cmd, out_len = self.trace[idx]
+            self.trace[idx] = (t_out, t_in, cmd, out_len)
+            self.bytes_in += len(reply[:size])
+        return reply[:size]
+
+    def close(self):
+        pass
+
+
+def sim_transports(count, latency=0.0, **device_args):
+    """ transports to count independent emulated devices, located at sim-1 .. sim-count """
+    return [SimTransport(SimCH55x(**device_args), latency=latency, location='sim-' + str(x + 1))
+            for x in range(count)]
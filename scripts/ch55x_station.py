@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""
+    Flashing station: one long running process programs board after board.
+    The images are loaded and encoded for every chip id once at startup, new
+    CH55x bootloaders (4348:55e0) are found by polling the bus, backing off
+    while nothing is plugged in, and are written, verified and started without
+    any per unit setup. Every unit gets a json record in the result file.
+    Per unit patches (serial numbers ...) from a csv file only re-encode the
+    frames they touch. SimDeviceSource replaces the USB bus with emulated devices.
+"""
+
+import sys
+import json
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, localtime, strftime
+from chflasher import CHflasher, CHflasherError, UsbTransport, encode_image, usb
+from ch55x_image import ImageError, load_image, parse_patch, load_patch_csv
+from ch55x_sim import SimCH55x, SimTransport
+
+# CH551, CH552, CH554, CH558 and CH559
+CHIP_IDS = (0x51, 0x52, 0x54, 0x58, 0x59)
+
+example_text = '''--------------------------------------------------------------------------------
+Example:
+
+ program every board plugged into the station hub with blink.bin, 4 at a time:
+
+ python3 scripts/ch55x_station.py -f blink.bin -o station.jsonl --window 8
+
+ CH552 boards get their own image, all other chips blink.bin:
+
+ python3 scripts/ch55x_station.py -f blink.bin --image 0x52=blink552.ihx
+
+ dry run with 20 emulated CH559 plugged in one every 50 ms:
+
+ python3 scripts/ch55x_station.py -f CH559_verify_test.bin --sim 20 --sim-interval 0.05
+
+ personalize every board with the next row of serials.csv (header: unit,0x3ff0), stops after the last row:
+
+ python3 scripts/ch55x_station.py -f blink.bin --patch-csv serials.csv
+
+ Stop with Ctrl+C, the units being programmed are finished first.
+'''
+
+
+class UsbDeviceSource:
+    """ CH55x bootloaders on the USB bus, found by polling """
+
+    def __init__(self):
+        self.devices = {}
+
+    def poll(self):
+        """ locations of the devices that appeared since the last poll """
+        devices = {UsbTransport.location_of(dev): dev
+                   for dev in usb.core.find(find_all=True, idVendor=0x4348, idProduct=0x55e0)}
+        # a device that left the bootloader or was unplugged is forgotten, so it is found again next time
+        new = sorted(location for location in devices if location not in self.devices)
+        self.devices = devices
+        return new
+
+    def open(self, location):
+        return UsbTransport(self.devices[location])
+
+
+class SimDeviceSource:
+    """
+    Emulated devices in place of the USB bus.
+    plug() connects a SimCH55x, it disappears after it started the application
+    or when unplug() is called, like a real board leaving the bootloader.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.devices = {}
+        self.present = set()
+        self.plugged = 0
+        self.lock = threading.Lock()
+
+    def plug(self, device, location=None):
+        with self.lock:
+            self.plugged += 1
+            location = location or 'sim-' + str(self.plugged)
+            self.devices[location] = device
+        return location
+
+    def unplug(self, location):
+        with self.lock:
+            self.devices.pop(location, None)
+
+    def poll(self):
+        with self.lock:
+            for location in [x for x, dev in self.devices.items() if dev.app_started]:
+                del self.devices[location]
+            new = sorted(location for location in self.devices if location not in self.present)
+            self.present = set(self.devices)
+        return new
+
+    def open(self, location):
+        with self.lock:
+            return SimTransport(self.devices[location], self.latency, location=location)
+
+
+class Station:
+    """
+    Programs every device the source reports.
+
+    images      {chip id: file name or FirmwareImage}, chip id None = image of all other chips
+    source      UsbDeviceSource or SimDeviceSource
+    results     file the unit records are appended to as json lines, None = not written
+    settings    dict of CHflasher attributes applied to every session (window, sparse, retries ...)
+    workers     units programmed at the same time
+    units       [(unit, patches)] of load_patch_csv, every device gets the next one, None = no per unit patches
+    """
+
+    # poll interval in seconds, doubled after every empty poll up to poll_max
+    poll_min = 0.01
+    poll_max = 0.2
+
+    def __init__(self, images, source, results=None, settings=None, workers=4, units=None):
+        self.source = source
+        self.units_left = None if units is None else list(units)
+        self.settings = settings or {}
+        self.workers = workers
+        self.images = {}
+        loaded = {}
+        for chipid, firmware in images.items():
+            if isinstance(firmware, str):
+                if firmware not in loaded:
+                    loaded[firmware] = load_image(firmware)
+                firmware = loaded[firmware]
+            self.images[chipid] = firmware
+        # everything the first packet of a unit needs is ready before it is plugged in
+        for chipid in CHIP_IDS:
+            image = self.image_for(chipid)
+            if image is not None:
+                encode_image(image, '1.1', chipid)
+                encode_image(image, '2.3', chipid)
+        self.results = open(results, 'a') if results else None
+        self.records = []
+        self.units = 0
+        self.lock = threading.Lock()
+
+    def image_for(self, chipid):
+        return self.images.get(chipid, self.images.get(None))
+
+    def close(self):
+        if self.results is not None:
+            self.results.close()
+            self.results = None
+
+    def __record(self, record):
+        with self.lock:
+            self.records.append(record)
+            if self.results is not None:
+                print(json.dumps(record), file=self.results, flush=True)
+        print('[{}] unit {}: {} {} {:.3f} s'.format(record['location'], record['unit'], record['chip'] or '-',
+                                                      record['result'], record['total_s']))
+
+    def flash_unit(self, location, t_seen):
+        """ writes, verifies and starts the device at location, returns its record """
+        serial, patches = None, []
+        with self.lock:
+            self.units += 1
+            unit = self.units
+            # a row is used up even when the unit fails, its serial is never given out twice
+            if self.units_left:
+                serial, patches = self.units_left.pop(0)
+        record = {'unit': unit, 'location': location, 'time': strftime('%Y-%m-%dT%H:%M:%S', localtime()),
+                  'serial': serial, 'chip': None, 'bootloader': None, 'image': None, 'result': 'ok', 'write_path': None,
+                  'retries': 0, 'wait_s': 0.0, 'flash_s': 0.0, 'total_s': 0.0}
+        t_start = monotonic()
+        flash = None
+        try:
+            flash = CHflasher(self.source.open(location))
+            flash.tag = location
+            for name, value in self.settings.items():
+                setattr(flash, name, value)
+            flash.patches = list(self.settings.get('patches') or []) + patches
+            flash.open()
+            record['chip'] = 'CH5' + str(flash.chipid - 30)
+            record['bootloader'] = flash.bootloader_ver
+            image = self.image_for(flash.chipid)
+            if image is None:
+                raise CHflasherError('no image for ' + record['chip'])
+            record['image'] = image.name
+            flash.write(image)
+        except CHflasherError as ex:
+            record['result'] = str(ex)
+        except Exception as ex:
+            record['result'] = 'USB error: ' + str(ex)
+        if flash is not None:
+            record['write_path'] = flash.write_path
+            record['retries'] = flash.retry_count
+            flash.close()
+        t_stop = monotonic()
+        record['wait_s'] = t_start - t_seen
+        record['flash_s'] = t_stop - t_start
+        record['total_s'] = t_stop - t_seen
+        self.__record(record)
+        return record
+
+    def run(self, count=None, stop=None):
+        """
+        polls the source and programs the new devices until count units were started or stop is set,
+        with per unit patches it stops after the last one at the latest
+        """
+        stop = stop or threading.Event()
+        if self.units_left is not None:
+            count = len(self.units_left) if count is None else min(count, len(self.units_left))
+        interval = self.poll_min
+        started = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while not stop.is_set() and (count is None or started < count):
+                arrivals = self.source.poll()
+                t_seen = monotonic()
+                for location in arrivals[:None if count is None else count - started]:
+                    pool.submit(self.flash_unit, location, t_seen)
+                    started += 1
+                interval = self.poll_min if arrivals else min(interval * 2, self.poll_max)
+                stop.wait(interval)
+        return self.records
+
+    def print_summary(self):
+        failed = [r for r in self.records if r['result'] != 'ok']
+        print(CHflasher.txt_sep)
+        print(str(len(self.records)) + ' units, ' + str(len(failed)) + ' failed')
+        done = [r['total_s'] for r in self.records if r['result'] == 'ok']
+        if done:
+            print('plug to done: mean {:.3f} s, max {:.3f} s'.format(sum(done) / len(done), max(done)))
+
+
+# image argument: CHIP=FILE, e.g. 0x52=blink552.bin
+def __image_setting(txt):
+    chip, _, file_name = txt.partition('=')
+    try:
+        chipid = int(chip, 0)
+    except ValueError:
+        raise argparse.ArgumentTypeError('image must be CHIP=FILE, e.g. 0x52=blink552.bin')
+    if chipid not in CHIP_IDS or not file_name:
+        raise argparse.ArgumentTypeError('image must be CHIP=FILE, CHIP one of ' +
+                                         ', '.join('0x{:02x}'.format(x) for x in CHIP_IDS))
+    return chipid, file_name
+
+
+def __plug_sim(source, count, chipid, interval, stop):
+    for _ in range(count):
+        if stop.wait(interval):
+            break
+        source.plug(SimCH55x(chipid=chipid))
+
+
+def __main(argv):
+    parser = argparse.ArgumentParser(description="CH55x flashing station.",
+                                     epilog=example_text,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-f', '--file', type=str, default=None, help="Image of all chips (.bin or .ihx).")
+    parser.add_argument('--image', type=__image_setting, action='append', default=[],
+                        help="Image of one chip id CHIP=FILE, can be repeated.")
+    parser.add_argument('-o', '--results', type=str, default='station.jsonl',
+                        help="Unit records are appended to this file, one json object per line.")
+    parser.add_argument('--workers', type=int, default=4, help="Units programmed at the same time.")
+    parser.add_argument('--count', type=int, default=None, help="Stop after this many units.")
+    parser.add_argument('--window', type=int, default=1, help="Write/verify packets kept in flight.")
+    parser.add_argument('--sparse', action='store_true', default=False,
+                        help="Do not write packets that already match the erased flash.")
+    parser.add_argument('--patch', type=str, action='append', default=[],
+                        help="Patch of every unit OFFSET=HEX, can be repeated.")
+    parser.add_argument('--patch-csv', type=str, default=None,
+                        help="Per unit patches, every unit gets the next row, the station stops after the last one.")
+    parser.add_argument('--fused', type=int, nargs='?', const=0, default=None,
+                        help="Verify every erase sector (or every N packets) right after writing it.")
+    parser.add_argument('--retries', type=int, default=CHflasher.retries, help="Retries of a timed out packet.")
+    parser.add_argument('--poll-max', type=float, default=Station.poll_max,
+                        help="Longest poll interval in seconds while idle.")
+    parser.add_argument('--sim', type=int, default=None, help="Program this many emulated devices instead of USB.")
+    parser.add_argument('--sim-chip', type=lambda x: int(x, 0), default=0x59, help="Chip id of the emulated devices.")
+    parser.add_argument('--sim-interval', type=float, default=0.1, help="Seconds between two emulated plug-ins.")
+    args = parser.parse_args(argv)
+
+    images = dict(args.image)
+    if args.file:
+        images[None] = args.file
+    if not images:
+        print('Error: no image, use -f and/or --image')
+        sys.exit(2)
+    stop = threading.Event()
+    if args.sim:
+        source = SimDeviceSource()
+        count = args.sim if args.count is None else min(args.count, args.sim)
+        threading.Thread(target=__plug_sim, args=(source, count, args.sim_chip, args.sim_interval, stop),
+                         daemon=True).start()
+    else:
+        if usb is None:
+            print('pyusb is not installed, install it via pip install pyusb')
+            sys.exit(2)
+        source = UsbDeviceSource()
+        count = args.count
+    try:
+        patches = [parse_patch(x) for x in args.patch]
+        units = load_patch_csv(args.patch_csv) if args.patch_csv else None
+        station = Station(images, source, args.results,
+                          {'window': args.window, 'sparse': args.sparse, 'fused': args.fused,
+                           'retries': args.retries, 'patches': patches}, args.workers, units)
+    except (OSError, ImageError) as ex:
+        print('Error: ' + str(ex))
+        sys.exit(2)
+    station.poll_max = args.poll_max
+    print('Station ready, ' + ', '.join(('all' if chipid is None else 'CH5' + str(chipid - 30)) + ': ' + image.name
+                                        for chipid, image in station.images.items()))
+    try:
+        station.run(count, stop)
+    except KeyboardInterrupt:
+        stop.set()
+    station.close()
+    station.print_summary()
+    print('Results saved: ' + args.results)
+    if any(r['result'] != 'ok' for r in station.records):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    __main(sys.argv[1:])
@@ -37,17 +37,161 @@
 # 5. Optional usb data logging: use the option --log. It will create a
 #    new log file with all the usb operations logged .
 #    If the logger is enabled, the chip will stay in the bootloader mode.
+# 6. USB access goes through a transport object (UsbTransport by default), so the
+#    flasher can also be driven by the bootloader emulator in ch55x_sim.py
+# 7. Pipelined write/verify: --window N keeps up to N packets in flight,
+#    --window 1 is the classic lock-step mode
+# 8. Sparse write: --sparse does not send packets that already match the erased
+#    flash, --sparse-verify selects if they are verified as erased or skipped
+# 9. --skip-identical runs a verify pass first and skips erase/write when the
+#    device already holds the image
+# 10. Gang programming: --all runs the operation on every connected CH55x in
+#    parallel, one session (and log file) per device, results per bus/port
+# 11. --capture FILE records the raw tx/rx frames into a pcap file with almost no
+#    per packet cost, ch55x_capture.py renders it into the --log text layout
+# 12. -f accepts .bin files (memory mapped) and the .ihx files sdcc writes,
+#    gaps between the Intel HEX segments are not sent
+# 13. Operations can be chained (-d -e -w -v -s), the chip is identified once per
+#    session; CHflasher.open()/close() and the with statement give the same
+#    session to scripts importing the flasher
+# 14. --profile FILE times every phase and USB round trip (p50/p95/p99/max per
+#    command) and exports json or Prometheus text, --profile-cpu adds a cProfile dump
+# 15. Per command transfer timeouts (--timeout erase=5000 ...) and bounded retry of
+#    timed out packets with backoff (--retries, --retry-backoff), retries are reported
+# 16. Erase covers only the sectors of the image (v1.1: the pages holding data), the
+#    erased and the fixed sector count are reported, --full-erase erases the fixed
+#    device span as before, extended to the image end when the image is larger
+# 17. --fused verifies every erase sector (or every N packets) right after writing it and
+#    stops at the first failing address, bad parts are rejected early
+# 18. Per unit patches (--patch OFFSET=HEX, --patch-csv FILE --unit ID) over a cached
+#    image, only the frames holding patched bytes are encoded again
+# 19. progress and cancel hooks, ch55x_async.py drives the flasher from asyncio
 #
 
-
-import usb.core
-import usb.util
+try:
+    import usb.core
+    import usb.util
+except ImportError:
+    usb = None
 import sys
 import os
+import errno
 import argparse
-import traceback
+import cProfile
 import platform
-from time import localtime, strftime
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, nullcontext
+from time import localtime, strftime, monotonic, sleep
+from ch55x_frames import encode_v1, encode_v2, FaultMap, CHUNK_V1, CHUNK_V2
+from ch55x_capture import CaptureWriter, CaptureTransport
+from ch55x_image import FirmwareImage, ImageError, load_image, parse_patch, load_patch_csv
+from ch55x_profile import Profiler, ProfileTransport
+
+
+class CHflasherError(Exception):
+    pass
+
+
+# a transfer still timed out after all retries
+class TransportTimeout(CHflasherError):
+    pass
+
+
+# the operation was stopped with CHflasher.cancel
+class Cancelled(CHflasherError):
+    pass
+
+
+# default transport: bulk endpoints of the first CH55x bootloader found on the bus
+# any object with write(data, timeout=None), read(size, timeout=None) and close() can be used instead,
+# timeouts are in ms and a transfer that times out raises TimeoutError
+# a device that can not be opened raises CHflasherError
+class UsbTransport:
+
+    def __init__(self, dev=None):
+        if usb is None:
+            raise CHflasherError('pyusb is not installed, install it via pip install pyusb')
+        if dev is None:
+            dev = usb.core.find(idVendor=0x4348, idProduct=0x55e0)
+        if dev is None:
+            raise CHflasherError('No CH55x device found, check driver please')
+        try:
+            dev.set_configuration()
+        except usb.core.USBError as ex:
+            if str(ex).startswith('[Errno 13]') and platform.system() == 'Linux':
+                raise CHflasherError('\n'.join((
+                    'No access to USB Device, configure udev or execute as root (sudo)',
+                    'For udev create /etc/udev/rules.d/99-ch55x.rules',
+                    'with one line:',
+                    '---',
+                    'SUBSYSTEM=="usb", ATTR{idVendor}=="4348", ATTR{idProduct}=="55e0", MODE="666"',
+                    '---',
+                    'Restart udev: sudo service udev restart',
+                    'Reconnect device, should work now!',
+                    'Alternativey use the included script:',
+                    'sudo ./linux_ch55x_install_udev_rules.sh'))) from ex
+            raise CHflasherError('Could not access USB Device: ' + str(ex)) from ex
+        cfg = dev.get_active_configuration()
+        intf = cfg[(0, 0)]
+        self.dev = dev
+        self.location = self.location_of(dev)
+        self.epout = usb.util.find_descriptor(intf, custom_match=lambda e: usb.util.endpoint_direction(
+            e.bEndpointAddress) == usb.util.ENDPOINT_OUT)
+        self.epin = usb.util.find_descriptor(intf, custom_match=lambda e: usb.util.endpoint_direction(
+            e.bEndpointAddress) == usb.util.ENDPOINT_IN)
+
+        assert self.epout is not None
+        assert self.epin is not None
+
+    # bus-port path, e.g. 1-3.2 for port 2 of the hub on port 3 of bus 1
+    @staticmethod
+    def location_of(dev):
+        ports = getattr(dev, 'port_numbers', None)
+        if ports:
+            return str(dev.bus) + '-' + '.'.join(str(x) for x in ports)
+        return str(dev.bus) + '-' + str(dev.address)
+
+    @staticmethod
+    def __timeout_error(ex):
+        timeout_error = getattr(usb.core, 'USBTimeoutError', None)
+        if (timeout_error is not None and isinstance(ex, timeout_error)) or ex.errno == errno.ETIMEDOUT:
+            return TimeoutError(str(ex))
+        return ex
+
+    def write(self, data, timeout=None):
+        try:
+            return self.epout.write(data, timeout)
+        except usb.core.USBError as ex:
+            raise self.__timeout_error(ex)
+
+    def read(self, size, timeout=None):
+        try:
+            return self.epin.read(size, timeout)
+        except usb.core.USBError as ex:
+            raise self.__timeout_error(ex)
+
+    def close(self):
+        usb.util.dispose_resources(self.dev)
+
+
+# stands in for a CH55x found on the bus that could not be opened, every transfer raises the error,
+# so the session of that port fails while the other devices are programmed
+class UnopenedTransport:
+
+    def __init__(self, location, error):
+        self.location = location
+        self.error = error
+
+    def write(self, data, timeout=None):
+        raise CHflasherError(self.error)
+
+    def read(self, size, timeout=None):
+        raise CHflasherError(self.error)
+
+    def close(self):
+        pass
 
 
 class CHflasher:
@@ -74,52 +218,119 @@ class CHflasher:
 
     device_erase_size = 8
     device_flash_size = 16
+    # erase size of the flash: 1 KiB sectors (v2.3 erase count) and v1.1 pages
+    sector_size = 1024
+    # smallest sector count the v2.3 erase command accepts
+    min_erase_sectors = 8
+    # erase the fixed device span instead of only the sectors under the image
+    full_erase = False
+    # sectors erased by the last erase and the fixed count a full erase takes
+    erase_sectors = None
+    erase_full_sectors = None
     chipid = 0
     log_file = None
     bootloader_ver = None
     xorer = 0
+    # number of write/verify packets in flight, 1 = lock-step
+    window = 1
+    # sparse write: skip packets matching erased flash, sparse_verify = 'erased' or 'skip'
+    sparse = False
+    sparse_verify = 'erased'
+    erased_value = 0xff
+    # fused write/verify: None = off, 0 = verify every erase sector right after writing it,
+    # N = verify every N packets, the first failure stops the write
+    fused = None
+    # verify first, erase and write only if the device content differs
+    verify_first = False
+    # path taken by the last write(): 'programmed' or 'skipped'
+    write_path = None
+    # CaptureWriter recording the raw USB frames, None = off
+    capture = None
+    # FirmwareImage of the last used file, loaded once per session
+    image = None
+    # byte patches [(address, bytes)] applied over the image, only the frames holding them are encoded again
+    patches = None
+    # key checksum sent to the v2.3 bootloader
+    key_checksum = None
+    # write/verify leave the bootloader and start the application when no log is written
+    auto_start = True
+    # Profiler timing the phases and USB round trips, None = off
+    profiler = None
+    # transfer timeouts in ms per command kind, erasing takes longer than the other commands
+    timeouts = {'detect': 1000, 'erase': 5000, 'write': 1000, 'verify': 1000}
+    # command byte -> kind, per bootloader version
+    command_kinds = {
+        '2.3': {0xa4: 'erase', 0xa5: 'write', 0xa6: 'verify'},
+        '1.1': {0xa6: 'erase', 0xa9: 'erase', 0xa8: 'write', 0xa7: 'verify'},
+    }
+    # a timed out packet is sent again up to retries times, waiting retry_backoff seconds
+    # before the first retry and doubling it for every further one
+    retries = 2
+    retry_backoff = 0.01
+    # progress(phase, done, total) is called at the start of every phase (done 0, total None) and
+    # for every write/verify packet, done counts the packets of the phase
+    progress = None
+    # threading.Event, once set the running operation stops at the next packet with Cancelled
+    cancel = None
+    # keeps the lines of parallel sessions apart
+    console_lock = threading.Lock()
 
-    def __init__(self):
-        pass
+    def __init__(self, transport=None):
+        self.transport = transport
+        # prefix of the console messages, set when several sessions share one console
+        self.tag = None
+        # chip identified in this session, see open()
+        self.identified = False
+        # timed out transfers sent again, total and per command byte
+        self.retry_count = 0
+        self.retry_counts = {}
+        # running phase, packets done in it and their total for progress
+        self.phase = None
+        self.phase_done = 0
+        self.phase_total = None
+
+    def __msg(self, text):
+        if self.tag is None:
+            print(text)
+        else:
+            with self.console_lock:
+                print('[' + self.tag + '] ' + text)
 
     def __init_usb(self):
-        dev = usb.core.find(idVendor=0x4348, idProduct=0x55e0)
-        if dev is None:
-            print('No CH55x device found, check driver please')
-            sys.exit()
-        try:
-            dev.set_configuration()
-        except usb.core.USBError as ex:
-            print('Could not access USB Device')
+        if self.transport is None:
+            with self.__phase('usb_open'):
+                try:
+                    self.transport = UsbTransport()
+                except CHflasherError as ex:
+                    self.__errorexit(str(ex))
+        if self.capture is not None and not isinstance(self.transport, CaptureTransport):
+            self.transport = CaptureTransport(self.transport, self.capture)
+        if self.profiler is not None and not isinstance(self.transport, ProfileTransport):
+            self.transport = ProfileTransport(self.transport, self.profiler)
 
-            if str(ex).startswith('[Errno 13]') and platform.system() == 'Linux':
-                print('No access to USB Device, configure udev or execute as root (sudo)')
-                print('For udev create /etc/udev/rules.d/99-ch55x.rules')
-                print('with one line:')
-                print('---')
-                print('SUBSYSTEM=="usb", ATTR{idVendor}=="4348", ATTR{idProduct}=="55e0", MODE="666"')
-                print('---')
-                print('Restart udev: sudo service udev restart')
-                print('Reconnect device, should work now!')
-                print('Alternativey use the included script:')
-                print('sudo ./linux_ch55x_install_udev_rules.sh')
-                sys.exit(2)
-
-            traceback.print_exc()
-            sys.exit(2)
-        cfg = dev.get_active_configuration()
-        intf = cfg[(0, 0)]
-        self.epout = usb.util.find_descriptor(intf, custom_match=lambda e: usb.util.endpoint_direction(
-            e.bEndpointAddress) == usb.util.ENDPOINT_OUT)
-        self.epin = usb.util.find_descriptor(intf, custom_match=lambda e: usb.util.endpoint_direction(
-            e.bEndpointAddress) == usb.util.ENDPOINT_IN)
+    # times a phase when profiling, tells progress about it
+    def __phase(self, name):
+        self.phase = name
+        self.phase_done = 0
+        self.phase_total = None
+        if self.progress is not None:
+            self.progress(name, 0, None)
+        if self.profiler is None:
+            return nullcontext()
+        return self.profiler.phase(name)
 
-        assert self.epout is not None
-        assert self.epin is not None
+    def set_capture(self, capture_file):
+        self.__msg("USB capture ON: " + capture_file)
+        self.capture = CaptureWriter(capture_file)
+
+    def close_capture(self):
+        if self.capture is not None:
+            self.capture.close()
+            self.capture = None
 
     def set_logger(self, setting, logfile):
         if setting:
-            print("Transaction logger ON: " + logfile)
+            self.__msg("Transaction logger ON: " + logfile)
             self.log_file = open(logfile, "w")        # open log file for writing
             print(self.txt_sep, file=self.log_file)
             time = strftime("%a, %d %b %Y %X +0000", localtime())
@@ -128,7 +339,8 @@ class CHflasher:
 
     def close_logger(self):
         if self.log_file is not None:
-            self.log_file.close();
+            self.log_file.close()
+            self.log_file = None
 
     @classmethod
     def show_info(cls):
@@ -145,18 +357,43 @@ class CHflasher:
     @staticmethod
     def usage():
         print("Usage:")
-        print("python3 chflasher.py [-h] [--version] [-f FILE] [-w | -v | -d | -e] [-s] [--log LOG]")
+        print("python3 chflasher.py [-h] [--version] [-f FILE] [-d] [-e] [-w] [-v] [-s] [--log LOG] [--capture FILE] [--window N]\n"
+              "                    [--sparse] [--sparse-verify erased|skip] [--erased-value VAL] [--skip-identical]\n"
+              "                    [--range START-STOP [--keep-going]] [--all] [--workers N]\n"
+              "                    [--timeout KIND=MS] [--retries N] [--retry-backoff S] [--full-erase] [--fused [N]]\n"
+              "                    [--patch OFFSET=HEX] [--patch-csv FILE --unit ID]\n"
+              "                    [--profile FILE] [--profile-cpu FILE]")
         print("Options:")
         print("\t-h\t\tshow help")
         print("\t--version\tshow version")
         print("\t--log LOG_FILE\twrite diagnostic log file")
+        print("\t--capture FILE\trecord raw USB frames into a pcap file (see ch55x_capture.py)")
+        print("\t--window N\twrite/verify packets kept in flight (default 1 = lock-step)")
+        print("\t--sparse\tskip packets matching the erased flash")
+        print("\t--sparse-verify erased|skip\tverify skipped packets as erased (default) or skip them")
+        print("\t--erased-value VAL\tvalue of an erased flash byte (default 0xff)")
+        print("\t--skip-identical\tverify first, skip erase/write if the device already matches")
+        print("\t--range START-STOP\tverify only this address range (with -v), can be repeated")
+        print("\t--keep-going\trange verify: collect all failures into a fault map")
+        print("\t--all\t\tgang mode, run the operation on every connected device in parallel")
+        print("\t--workers N\tdevices programmed at the same time in gang mode")
+        print("\t--timeout KIND=MS\ttransfer timeout for detect, erase, write or verify, can be repeated")
+        print("\t--retries N\tretries of a timed out packet (default 2)")
+        print("\t--retry-backoff S\twait before the first retry, doubled for every further one")
+        print("\t--fused [N]\tverify every sector (or N packets) right after writing it, stop at the first failure")
+        print("\t--patch OFFSET=HEX\tpatch bytes of the image, can be repeated")
+        print("\t--patch-csv FILE --unit ID\tpatch with the row ID of a per unit csv file")
+        print("\t--full-erase\terase the whole fixed span (up to the image end if larger), not only the sectors the image needs")
+        print("\t--profile FILE\ttime phases and USB round trips, json or .prom (Prometheus) file")
+        print("\t--profile-cpu FILE\tcProfile dump of the host side CPU time")
         print("Operations:")
         print("\t-d\t\tidentify chip")
-        print("\t-e\t\terase flash")
-        print("\t-f FILE\tinput bin file")
+        print("\t-e\t\terase flash, with -f only the sectors the file needs")
+        print("\t-f FILE\tinput bin or ihx file")
         print("\t-w\t\twrite bin file to flash")
         print("\t-v\t\tverify the flash against the bin file")
         print("\t-s\t\texit bootloader/start application")
+        print("Operations can be combined, they run in one session in the order -d -e -w -v -s")
         print("Example:")
         print("python3 chflasher.py --log usb.log -w -f blink.bin")
         print("will write the blink.bin file, verify it and log the usb operations")
@@ -183,20 +420,180 @@ class CHflasher:
         if len(rx):
             print(':'.join('{:02x}'.format(x) for x in tx), file=self.log_file)
 
-    def __errorexit(self, errormsg):
-        print(self.txt_sep)
-        print('Error: ' + errormsg)
-        print(self.txt_sep)
+    def __errorexit(self, errormsg, error=CHflasherError):
+        self.__msg(self.txt_sep)
+        self.__msg('Error: ' + errormsg)
+        self.__msg(self.txt_sep)
         if self.log_file is not None:
             print(self.txt_sep, file=self.log_file)
             print(errormsg, file=self.log_file)
             self.log_file.close()
-        sys.exit()
+            self.log_file = None
+        raise error(errormsg)
 
-    def __sendcmd(self, cmd):
-        self.epout.write(cmd)
-        b = self.epin.read(64)
-        return b
+    def __timeout(self, cmd):
+        kind = self.command_kinds.get(self.bootloader_ver, {}).get(cmd, 'detect')
+        return self.timeouts.get(kind)
+
+    # counts a retry of cmd, gives up with TransportTimeout after the last one
+    def __retry(self, cmd, attempt):
+        if attempt >= self.retries:
+            self.__errorexit('USB timeout, command ' + '0x{:02x}'.format(cmd) + ' not answered after ' +
+                             str(self.retries) + ' retries', TransportTimeout)
+        self.retry_count += 1
+        self.retry_counts[cmd] = self.retry_counts.get(cmd, 0) + 1
+        self.__msg('USB timeout, command ' + '0x{:02x}'.format(cmd) + ', retry ' + str(attempt + 1) + ' of ' +
+                   str(self.retries))
+        if self.log_file is not None:
+            print("USB timeout, command " + '0x{:02x}'.format(cmd) + ", retry " + str(attempt + 1),
+                  file=self.log_file)
+        sleep(self.retry_backoff * (2 ** attempt))
+
+    # stops the operation with Cancelled once cancel is set
+    def __checkcancel(self):
+        if self.cancel is not None and self.cancel.is_set():
+            self.__errorexit('Cancelled', Cancelled)
+
+    # all commands sent with __sendcmd are idempotent, a timed out one is simply sent again
+    # attempt: retries of cmd already used, e.g. by the windowed transfer
+    def __sendcmd(self, cmd, attempt=0):
+        self.__checkcancel()
+        timeout = self.__timeout(cmd[0])
+        while True:
+            try:
+                self.transport.write(cmd, timeout)
+                return self.transport.read(64, timeout)
+            except TimeoutError:
+                self.__retry(cmd[0], attempt)
+                attempt += 1
+
+    # commands without reply, e.g. leaving the bootloader, are retried on a timed out OUT transfer only,
+    # transports that track replies (profile, capture) are told that none will come
+    def __sendonly(self, cmd):
+        write = getattr(self.transport, 'write_unanswered', self.transport.write)
+        attempt = 0
+        while True:
+            try:
+                write(cmd, self.timeouts.get('detect'))
+                return
+            except TimeoutError:
+                self.__retry(cmd[0], attempt)
+                attempt += 1
+
+    # sends the frames and yields (address, length, frame, reply) in frame order
+    def __sendframes(self, frames):
+        if self.progress is None and self.cancel is None:
+            return self.__transfer(frames)
+        return self.__tracked(frames)
+
+    # __transfer reporting every reply to progress and stopping when cancel is set
+    def __tracked(self, frames):
+        total = self.phase_total or len(frames)
+        with closing(self.__transfer(frames)) as replies:
+            for reply in replies:
+                self.__checkcancel()
+                self.phase_done += 1
+                if self.progress is not None:
+                    self.progress(self.phase, self.phase_done, total)
+                yield reply
+
+    # with window > 1 a writer thread keeps up to window OUT transfers ahead of the replies,
+    # after a timeout the packets not answered yet are sent again in lock-step
+    def __transfer(self, frames):
+        if self.window <= 1:
+            for addr, length, frame in frames:
+                yield addr, length, frame, self.__sendcmd(frame)
+            return
+        frames = iter(frames)
+        slots = threading.Semaphore(self.window)
+        stop = threading.Event()
+        sent = deque()
+        sent_cv = threading.Condition()
+        # frame taken by the writer but not sent when it was stopped
+        unsent = []
+
+        def writer():
+            result = None
+            for item in frames:
+                slots.acquire()
+                if stop.is_set():
+                    unsent.append(item)
+                    break
+                try:
+                    self.transport.write(item[2], self.__timeout(item[2][0]))
+                except Exception as ex:
+                    if isinstance(ex, TimeoutError):
+                        unsent.append(item)
+                    result = ex
+                    break
+                with sent_cv:
+                    sent.append(item)
+                    sent_cv.notify()
+            with sent_cv:
+                sent.append(result)
+                sent_cv.notify()
+
+        # stops the writer, returns the frames sent and not answered yet
+        def stop_writer():
+            stop.set()
+            slots.release()
+            thread.join()
+            return [x for x in sent if x is not None and not isinstance(x, Exception)]
+
+        def writer_error():
+            for x in sent:
+                if isinstance(x, Exception) and not isinstance(x, TimeoutError):
+                    return x
+            return None
+
+        thread = threading.Thread(target=writer, daemon=True)
+        thread.start()
+        resend = None
+        try:
+            while True:
+                with sent_cv:
+                    sent_cv.wait_for(lambda: len(sent) > 0)
+                    item = sent.popleft()
+                if item is None:
+                    break
+                if isinstance(item, TimeoutError):
+                    # the OUT transfer of the next packet stalled, nothing of it was sent
+                    resend = stop_writer()
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                try:
+                    reply = self.transport.read(64, self.__timeout(item[2][0]))
+                except TimeoutError:
+                    resend = [item] + stop_writer()
+                    if writer_error() is not None:
+                        raise writer_error()
+                    break
+                slots.release()
+                yield item[0], item[1], item[2], reply
+        finally:
+            if resend is None:
+                # fail fast: stop the writer and collect the replies of packets already sent
+                for _ in stop_writer():
+                    try:
+                        self.transport.read(64, self.timeouts.get('detect'))
+                    except Exception:
+                        pass
+        if resend is None:
+            return
+        # late replies of the stalled packets are dropped, then all of them are sent again,
+        # the first one is the packet that timed out, its retry counts against --retries
+        resend += unsent
+        self.__retry(resend[0][2][0], 0)
+        for _ in resend:
+            try:
+                self.transport.read(64, max(1, int(self.retry_backoff * 1000)))
+            except Exception:
+                break
+        for n, (addr, length, frame) in enumerate(resend):
+            yield addr, length, frame, self.__sendcmd(frame, 1 if n == 0 else 0)
+        for addr, length, frame in frames:
+            yield addr, length, frame, self.__sendcmd(frame)
 
     def __detect_bootloader_ver(self):
         ver = None
@@ -210,18 +607,57 @@ class CHflasher:
             ver = '1.1'
         else:
             ver = '2.3'
+        self.bootloader_ver = ver
         return ver
 
+    # sectors to erase for the loaded image and the sector count of a full erase
+    # v1.1 erases page by page, only the pages holding a segment are erased, the v2.3 erase
+    # command always starts at address 0 and covers the image up to its end
+    # without an image, or with full_erase set, the fixed device span is erased as before,
+    # extended to the image end when the image is larger
+    # parts with a fixed span of min_erase_sectors (8) have nothing to trim on v2.3
+    def __erasesectors(self, bt_version):
+        if bt_version == '1.1':
+            full = self.device_flash_size
+            if self.image is not None:
+                sectors = sorted({x for addr, data in self.image.segments if len(data)
+                                  for x in range(addr // self.sector_size,
+                                                 (addr + len(data) - 1) // self.sector_size + 1)})
+        else:
+            full = self.device_erase_size
+            if self.image is not None:
+                count = -(-self.image.size // self.sector_size)
+                sectors = list(range(min(max(count, self.min_erase_sectors), self.device_flash_size)))
+        if self.image is None or not self.image.size:
+            return list(range(full)), full
+        # never erase less than the image needs, even when the fixed count is smaller
+        full = max(full, sectors[-1] + 1)
+        if self.full_erase:
+            return list(range(full)), full
+        return sectors, full
+
+    def __erased(self, sectors, full):
+        self.erase_sectors = len(sectors)
+        self.erase_full_sectors = full
+        if len(sectors) >= full:
+            self.__msg('Flash Erased')
+            return
+        self.__msg('Flash Erased: ' + str(len(sectors)) + ' of ' + str(full) + ' sectors')
+        if self.log_file is not None:
+            print("Erased " + str(len(sectors)) + " of " + str(full) + " sectors", file=self.log_file)
+
     def __erasechipv1(self):
+        sectors, full = self.__erasesectors('1.1')
         self.__sendcmd((0xa6, 0x04, 0x00, 0x00, 0x00, 0x00))
-        for x in range(self.device_flash_size):
+        for x in sectors:
             buffer = self.__sendcmd((0xa9, 0x02, 0x00, x*4))
             if buffer[0] != 0x00:
                 self.__errorexit('Erase Failed')
-        print('Flash Erased')
+        self.__erased(sectors, full)
 
     def __erasechipv2(self):
-        tx = (0xa4, 0x01, 0x00, self.device_erase_size)
+        sectors, full = self.__erasesectors('2.3')
+        tx = (0xa4, 0x01, 0x00, len(sectors))
         reply = self.__sendcmd(tx)
         if self.log_file is not None:
             print(self.txt_sep, file=self.log_file)
@@ -229,17 +665,17 @@ class CHflasher:
             self.__print_buffers(tx, reply)
         if reply[4] != 0x00:
             self.__errorexit('Erase Failed')
-        print('Flash Erased')
+        self.__erased(sectors, full)
 
     def __exitbootloaderv1(self):
-        self.epout.write(self.chip_v1["exit_bootloader"])
+        self.__sendonly(self.chip_v1["exit_bootloader"])
         if self.log_file is not None:
             print(self.txt_sep, file=self.log_file)
             print("Starting application:", file=self.log_file)
             self.__print_buffers(self.chip_v1["exit_bootloader"], "")
 
     def __exitbootloaderv2(self):
-        self.epout.write(self.chip_v1["exit_bootloader"])
+        self.__sendonly(self.chip_v1["exit_bootloader"])
         if self.log_file is not None:
             print(self.txt_sep, file=self.log_file)
             print("Starting application:", file=self.log_file)
@@ -249,7 +685,7 @@ class CHflasher:
         reply = self.__sendcmd(self.chip_v1["detect_seq"])
         if len(reply) == 2:
             self.chipid = reply[0]
-            print('Found CH5'+str(self.chipid-30))
+            self.__msg('Found CH5'+str(self.chipid-30))
             if self.chipid == 0x58:
                 self.device_flash_size = 64
                 self.device_erase_size = 11
@@ -260,7 +696,7 @@ class CHflasher:
             self.__errorexit('Unknown chip')
         cfganswer = self.__sendcmd((0xbb, 0x00))
         if len(cfganswer) == 2:
-            print('Bootloader version: ' + str((cfganswer[0] >> 4)) + '.' + str((cfganswer[0] & 0xf)))
+            self.__msg('Bootloader version: ' + str((cfganswer[0] >> 4)) + '.' + str((cfganswer[0] & 0xf)))
         else:
             self.__errorexit('Unknown bootloader')
 
@@ -273,7 +709,7 @@ class CHflasher:
         if len(reply) == 6:
             self.chipid = reply[4]
 
-            print('Found CH5'+str(self.chipid-30))
+            self.__msg('Found CH5'+str(self.chipid-30))
             if self.chipid == 0x58:
                 self.device_flash_size = 64
                 self.device_erase_size = 11
@@ -288,7 +724,7 @@ class CHflasher:
             print("Config read:", file=self.log_file)
             self.__print_buffers(self.chip_v2["read_config"], read_cfg_reply)
         if len(read_cfg_reply) == 30:
-            print('Bootloader version: ' + str(read_cfg_reply[19]) + '.' + str(read_cfg_reply[20]) +
+            self.__msg('Bootloader version: ' + str(read_cfg_reply[19]) + '.' + str(read_cfg_reply[20]) +
                   str(read_cfg_reply[21]))
             self.__keyinputv2(read_cfg_reply)
         else:
@@ -306,53 +742,109 @@ class CHflasher:
         for x in range(0x30):
             outbuffer[x+3] = checksum & 0xff
         reply = self.__sendcmd(outbuffer)
+        self.key_checksum = checksum & 0xff
+        self.xorer = ((checksum + 0x52) % 256) % 256
         if self.log_file is not None:
             print(self.txt_sep, file=self.log_file)
             print("Key input:", file=self.log_file)
             print("Checksum: " + str(hex(checksum & 0xFF)), file=self.log_file)
-            self.xorer = ((checksum + 0x52) % 256) % 256
             print("Xorer: " + str(hex(self.xorer & 0xFF)), file=self.log_file)
             print("ChipID = " + str(hex(self.chipid)), file=self.log_file)
             self.__print_buffers(outbuffer, reply)
 
-    def __writefilev1(self, file_name, mode):
-        input_file = list(open(file_name, 'rb').read())
-        bytes_to_send = os.path.getsize(bytes(input_file))
+    # firmware: file name (.bin, .ihx, .hex) or an already loaded FirmwareImage
+    def __loadimage(self, firmware):
+        if isinstance(firmware, FirmwareImage):
+            self.image = firmware
+        elif self.image is None or self.image.name != firmware:
+            try:
+                self.image = load_image(firmware)
+            except (OSError, ImageError) as ex:
+                self.__errorexit('Can not load ' + str(firmware) + ': ' + str(ex))
+        return self.image
+
+    def __encodefile(self, firmware, bt_version):
+        # the image is encoded once per bootloader and chip id and kept with it, write and verify
+        # of all sessions reuse the frames, every session gets its own copy to set the mode byte in
+        with self.__phase('encode'):
+            frames = encode_image(self.__loadimage(firmware), bt_version, self.chipid)
+            if not self.patches:
+                return frames.copy()
+            try:
+                return frames.patched(self.patches)
+            except ValueError as ex:
+                self.__errorexit(str(ex))
+
+    # after an erase: frames to write and frames to verify
+    def __sparseframes(self, frames):
+        if not self.sparse:
+            return frames, frames
+        write_frames = frames.sparse(self.erased_value)
+        skipped = len(frames) - len(write_frames)
+        self.__msg('Sparse write: skipped ' + str(skipped) + ' of ' + str(len(frames)) + ' packets')
+        if self.log_file is not None:
+            print(self.txt_sep, file=self.log_file)
+            print("Sparse write: skipped " + str(skipped) + " of " + str(len(frames)) + " packets, erased value " +
+                  '0x{:02x}'.format(self.erased_value), file=self.log_file)
+        if self.sparse_verify == 'skip':
+            return write_frames, write_frames
+        return write_frames, frames
+
+    # quiet verify pass, returns the address of the first mismatch or None
+    def __checkframes(self, frames, bt_version):
+        if bt_version == '1.1':
+            frames.set_mode(self.chip_v1["mode_verify"])
+        else:
+            frames.set_mode(self.chip_v2["mode_verify"])
+        if self.log_file is not None:
+            print(self.txt_sep, file=self.log_file)
+            print("Checking " + str(frames.size) + " bytes of Flash before writing.", file=self.log_file)
+        with closing(self.__sendframes(frames)) as replies:
+            for addr, pkt_length, outbuffer, buffer in replies:
+                if bt_version == '1.1':
+                    failed = buffer[0] != 0x00
+                else:
+                    if self.log_file is not None:
+                        self.__print_buffer_errors(outbuffer, buffer, addr)
+                    failed = buffer[4] != 0x00 and buffer[4] != 0xfe
+                if failed:
+                    return addr
+        return None
+
+    # verify_first: True when the device already holds the frames
+    def __identical(self, frames, bt_version):
+        if not self.verify_first:
+            return False
+        with self.__phase('check'):
+            mismatch = self.__checkframes(frames, bt_version)
+        if mismatch is None:
+            self.__msg('Device content identical, skipping erase and write')
+            self.write_path = 'skipped'
+            return True
+        self.__msg('Device content differs at ' + '0x{:>04x}'.format(mismatch) + ', programming')
+        return False
+
+    def __writefilev1(self, frames, mode):
         if mode == self.chip_v1["mode_write"]:
-            print('Filesize: '+str(bytes_to_send)+' bytes')
-        curr_addr = 0
-        pkt_length = 0
-        while curr_addr < bytes_to_send:
-            outbuffer = bytearray(64)
-            if bytes_to_send >= 0x3c:
-                pkt_length = 0x3c
-            else:
-                pkt_length = bytes_to_send
-            outbuffer[0] = mode
-            outbuffer[1] = pkt_length
-            outbuffer[2] = (curr_addr & 0xff)
-            outbuffer[3] = ((curr_addr >> 8) & 0xff)
-            for x in range(pkt_length):
-                outbuffer[x+4] = input_file[curr_addr+x]
-            buffer = self.__sendcmd(outbuffer)
-            curr_addr += pkt_length
-            bytes_to_send -= pkt_length
-            if buffer is not None:
-                if buffer[0] != 0x00:
-                    if mode == self.chip_v1["mode_write"]:
-                        self.__errorexit('Write Failed!!!')
-                    elif mode == self.chip_v1["mode_verify"]:
-                        self.__errorexit('Verify Failed!!!')
+            self.__msg('Filesize: '+str(frames.size)+' bytes')
+        frames.set_mode(mode)
+        with closing(self.__sendframes(frames)) as replies:
+            for addr, pkt_length, outbuffer, buffer in replies:
+                if buffer is not None:
+                    if buffer[0] != 0x00:
+                        if mode == self.chip_v1["mode_write"]:
+                            self.__errorexit('Write Failed!!!')
+                        elif mode == self.chip_v1["mode_verify"]:
+                            self.__errorexit('Verify Failed!!!')
         if mode == self.chip_v1["mode_write"]:
-            print('Writing success')
+            self.__msg('Writing success')
         elif mode == self.chip_v1["mode_verify"]:
-            print('Verify success')
+            self.__msg('Verify success')
 
-    def __writefilev2(self, file_name, mode):
-        input_file = list(open(file_name, 'rb').read())
-        bytes_to_send = len(input_file)
+    def __writefilev2(self, frames, mode):
+        bytes_to_send = frames.size
         if mode == self.chip_v2["mode_write"]:
-            print('Filesize: ' + str(bytes_to_send) + ' bytes')
+            self.__msg('Filesize: ' + str(bytes_to_send) + ' bytes')
             if self.log_file is not None:
                 print(self.txt_sep, file=self.log_file)
                 print("Writing " + str(bytes_to_send) + " bytes to Flash.", file=self.log_file)
@@ -366,195 +858,557 @@ class CHflasher:
                       file=self.log_file)
         if bytes_to_send < 256:
             self.__errorexit('Firmware bin file possibly corrupt.')
-        curr_addr = 0
-        pkt_length = 0
-        while curr_addr < bytes_to_send:
-            outbuffer = bytearray(64)
-            if bytes_to_send >= 0x38:
-                pkt_length = 0x38
-            else:
-                pkt_length = bytes_to_send
-            outbuffer[0] = mode
-            outbuffer[1] = (pkt_length+5)
-            outbuffer[2] = 0x00
-            outbuffer[3] = (curr_addr & 0xff)
-            outbuffer[4] = ((curr_addr >> 8) & 0xff)
-            outbuffer[5] = 0x00
-            outbuffer[6] = 0x00
-            outbuffer[7] = bytes_to_send & 0xff
-            for x in range(pkt_length):
-                outbuffer[x+8] = input_file[curr_addr + x]
-            for x in range(pkt_length+8):
-                if x % 8 == 7:
-                    outbuffer[x] ^= self.chipid
-                    # outbuffer[x] ^= self.xorer
-            buffer = self.__sendcmd(outbuffer)
-            # --- logger ---
-            if self.log_file is not None:
-                self.__print_buffer_errors(outbuffer, buffer, curr_addr)
-            curr_addr += pkt_length
-            bytes_to_send -= pkt_length
-            if buffer is not None:
-                if buffer[4] != 0x00 and buffer[4] != 0xfe:
-                    if mode == self.chip_v2["mode_write"]:
-                        self.__errorexit('Write Failed at address ' + str(curr_addr))
-                    elif mode == self.chip_v2["mode_verify"]:
-                        # if the logger is ON, do not exit on verify fail, check all the adresses
-                        if self.log_file is not None:
-                            print("Verify failed at " + '0x{:>04x}'.format(curr_addr))
-                        else:
-                            self.__errorexit('Verify Faile at address ' + str(curr_addr))
+        frames.set_mode(mode)
+        with closing(self.__sendframes(frames)) as replies:
+            for curr_addr, pkt_length, outbuffer, buffer in replies:
+                # --- logger ---
+                if self.log_file is not None:
+                    self.__print_buffer_errors(outbuffer, buffer, curr_addr)
+                if buffer is not None:
+                    if buffer[4] != 0x00 and buffer[4] != 0xfe:
+                        if mode == self.chip_v2["mode_write"]:
+                            self.__errorexit('Write Failed at address ' + str(curr_addr))
+                        elif mode == self.chip_v2["mode_verify"]:
+                            # if the logger is ON, do not exit on verify fail, check all the adresses
+                            if self.log_file is not None:
+                                self.__msg("Verify failed at " + '0x{:>04x}'.format(curr_addr))
+                            else:
+                                self.__errorexit('Verify Faile at address ' + str(curr_addr))
         if mode == self.chip_v2["mode_write"]:
-            print('Writing success')
+            self.__msg('Writing success')
         elif mode == self.chip_v2["mode_verify"]:
-            print('Verify success')
-
-    def __verify_rangev2(self, file_name, start, stop):
-        input_file = list(open(file_name, 'rb').read())
-        if stop < start:
-            self.__errorexit("Wrong range, stop < start!")
-
-        bytes_to_send = stop - start
+            self.__msg('Verify success')
 
+    # writes and verifies the frames block by block (see fused), stops at the first failing packet
+    def __writefused(self, write_frames, verify_frames, bt_version):
+        if bt_version == '1.1':
+            mode_write, mode_verify = self.chip_v1["mode_write"], self.chip_v1["mode_verify"]
+        else:
+            mode_write, mode_verify = self.chip_v2["mode_write"], self.chip_v2["mode_verify"]
+            if verify_frames.size < 256:
+                self.__errorexit('Firmware bin file possibly corrupt.')
+        txt_block = 'sector' if not self.fused else str(self.fused) + ' packets'
+        self.__msg('Filesize: ' + str(verify_frames.size) + ' bytes, verify every ' + txt_block)
         if self.log_file is not None:
             print(self.txt_sep, file=self.log_file)
-            print("Veryfing address range from" + str(start) + " to " + str(stop), file=self.log_file)
+            print("Writing and veryfing " + str(verify_frames.size) + " bytes of Flash, every " + txt_block + ".",
+                  file=self.log_file)
             print("add=          " + '|'.join('{:02x}'.format(x) for x in range(64)),
                   file=self.log_file)
+        self.phase_total = len(write_frames) + len(verify_frames)
+        write_blocks = write_frames.blocks(self.fused)
+        verify_blocks = verify_frames.blocks(self.fused)
+        packets = 0
+        for key in sorted(set(write_blocks) | set(verify_blocks)):
+            for frames, mode in ((write_blocks.get(key), mode_write), (verify_blocks.get(key), mode_verify)):
+                if frames is None:
+                    continue
+                frames.set_mode(mode)
+                with closing(self.__sendframes(frames)) as replies:
+                    for addr, pkt_length, outbuffer, buffer in replies:
+                        packets += 1
+                        if bt_version == '1.1':
+                            failed = buffer[0] != 0x00
+                        else:
+                            if self.log_file is not None:
+                                self.__print_buffer_errors(outbuffer, buffer, addr)
+                            failed = buffer[4] != 0x00 and buffer[4] != 0xfe
+                        if failed and mode == mode_write:
+                            self.__errorexit('Write Failed at address ' + str(addr))
+                        if failed:
+                            self.__errorexit('Verify failed at address ' + '0x{:>04x}'.format(addr) +
+                                             ', stopped after ' + str(packets) + ' of ' +
+                                             str(len(write_frames) + len(verify_frames)) + ' packets')
+        self.__msg('Writing and verify success')
 
-        curr_addr = start
-        pkt_length = 0
-        while curr_addr < bytes_to_send:
-            outbuffer = bytearray(64)
-            if bytes_to_send >= 0x38:
-                pkt_length = 0x38
-            else:
-                pkt_length = bytes_to_send
-            outbuffer[0] = self.chip_v2["mode_verify"]
-            outbuffer[1] = (pkt_length+5)
-            outbuffer[2] = 0x00
-            outbuffer[3] = (curr_addr & 0xff)
-            outbuffer[4] = ((curr_addr >> 8) & 0xff)
-            outbuffer[5] = 0x00
-            outbuffer[6] = 0x00
-            outbuffer[7] = bytes_to_send & 0xff
-            for x in range(pkt_length):
-                outbuffer[x+8] = input_file[curr_addr + x]
-            for x in range(pkt_length+8):
-                if x % 8 == 7:
-                    outbuffer[x] ^= self.chipid
-                    # outbuffer[x] ^= self.xorer
-            buffer = self.__sendcmd(outbuffer)
-            # --- logger ---
-            if self.log_file is not None:
-                self.__print_buffer_errors(outbuffer, buffer, curr_addr)
-            curr_addr += pkt_length
-            bytes_to_send -= pkt_length
-            if buffer is not None:
-                if buffer[4] != 0x00 and buffer[4] != 0xfe:
-                    # if the logger is ON, do not exit on verify fail, check all the adresses
+    # verify only the frames overlapping the address ranges
+    # keep_going: do not stop at the first failure, collect all of them in the returned FaultMap
+    def __verifyranges(self, frames, bt_version, ranges, keep_going):
+        # a range without any packet of the image would pass without verifying anything
+        for start, stop in ranges:
+            if not len(frames.ranges([(start, stop)])):
+                self.__errorexit('Range 0x{:04x}-0x{:04x} is outside the image'.format(start, stop))
+        frames = frames.ranges(ranges)
+        if bt_version == '1.1':
+            frames.set_mode(self.chip_v1["mode_verify"])
+            faults = FaultMap(CHUNK_V1)
+        else:
+            frames.set_mode(self.chip_v2["mode_verify"])
+            faults = FaultMap(CHUNK_V2)
+        txt_ranges = ', '.join('0x{:04x}-0x{:04x}'.format(start, stop) for start, stop in ranges)
+        self.__msg('Verifying ' + str(len(frames)) + ' packets in ' + txt_ranges)
+        if self.log_file is not None:
+            print(self.txt_sep, file=self.log_file)
+            print("Veryfing address ranges " + txt_ranges, file=self.log_file)
+            print("add=          " + '|'.join('{:02x}'.format(x) for x in range(64)),
+                  file=self.log_file)
+        with closing(self.__sendframes(frames)) as replies:
+            for addr, pkt_length, outbuffer, buffer in replies:
+                if bt_version == '1.1':
+                    failed = buffer[0] != 0x00
+                else:
                     if self.log_file is not None:
-                        print("Verify failed at " + '0x{:>04x}'.format(curr_addr))
-                    else:
-                        self.__errorexit('Verify Faile at address ' + str(curr_addr))
-            print('Verify success')
+                        self.__print_buffer_errors(outbuffer, buffer, addr)
+                    failed = buffer[4] != 0x00 and buffer[4] != 0xfe
+                if failed:
+                    if not keep_going:
+                        self.__errorexit('Verify failed at address ' + '0x{:>04x}'.format(addr))
+                    faults.add(addr, pkt_length)
+        if len(faults):
+            self.__msg('Verify failed in ' + str(len(faults)) + ' of ' + str(len(frames)) + ' packets: ' + str(faults))
+            if self.log_file is not None:
+                print(self.txt_sep, file=self.log_file)
+                print("Fault map: " + str(faults), file=self.log_file)
+                print("Fault bitmap: " + faults.bitmap.hex(), file=self.log_file)
+        else:
+            self.__msg('Verify success')
+        return faults
 
-    def write(self, firmware_bin):
-        self.__init_usb()
-        bt_version = self.__detect_bootloader_ver()
-        if bt_version == '1.1':
-            self.__identchipv1()
-            self.__erasechipv1()
-            self.__writefilev1(firmware_bin, self.chip_v1["mode_write"])
-            self.__writefilev1(firmware_bin, self.chip_v1["mode_verify"])
-            if self.log_file is None:
+    # identifies the chip once, later operations of the session reuse the cached result
+    def __open(self):
+        if not self.identified:
+            self.__init_usb()
+            with self.__phase('identify'):
+                bt_version = self.__detect_bootloader_ver()
+                if bt_version == '1.1':
+                    self.__identchipv1()
+                if bt_version == '2.3':
+                    self.__identchipv2()
+            self.identified = True
+        return self.bootloader_ver
+
+    def __exitbootloader(self, bt_version):
+        with self.__phase('exit'):
+            if bt_version == '1.1':
                 self.__exitbootloaderv1()
-        if bt_version == '2.3':
-            self.__identchipv2()
-            self.__erasechipv2()
-            self.__writefilev2(firmware_bin, self.chip_v2["mode_write"])
-            self.__writefilev2(firmware_bin, self.chip_v2["mode_verify"])
-            if self.log_file is None:
+            if bt_version == '2.3':
                 self.__exitbootloaderv2()
+        # the device left the bootloader, a new session has to identify it again
+        self.identified = False
+
+    # opens the session: USB device, bootloader version, chip id and key
+    def open(self):
+        self.__open()
+        return self
+
+    # closes the log, capture and USB device, the chip stays in the bootloader
+    def close(self):
+        self.close_logger()
+        self.close_capture()
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+        self.identified = False
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
+
+    # labels of the exported profile
+    def profile_labels(self):
+        labels = {'bootloader': self.bootloader_ver or ''}
+        if self.chipid:
+            labels['chip'] = 'CH5' + str(self.chipid - 30)
+        if self.tag is not None:
+            labels['port'] = self.tag
+        return labels
+
+    # cached identification of the session
+    def info(self):
+        return {
+            'chipid': self.chipid,
+            'bootloader': self.bootloader_ver,
+            'flash_size': self.device_flash_size * 1024,
+            'erase_size': self.device_erase_size * 1024,
+            'key_checksum': self.key_checksum,
+        }
+
+    def write(self, firmware_bin):
+        self.write_path = None
+        bt_version = self.__open()
+        frames = self.__encodefile(firmware_bin, bt_version)
+        if not self.__identical(frames, bt_version):
+            write_frames, verify_frames = self.__sparseframes(frames)
+            if self.fused is not None:
+                with self.__phase('erase'):
+                    if bt_version == '1.1':
+                        self.__erasechipv1()
+                    else:
+                        self.__erasechipv2()
+                with self.__phase('write_verify'):
+                    self.__writefused(write_frames, verify_frames, bt_version)
+            elif bt_version == '1.1':
+                with self.__phase('erase'):
+                    self.__erasechipv1()
+                with self.__phase('write'):
+                    self.__writefilev1(write_frames, self.chip_v1["mode_write"])
+                with self.__phase('verify'):
+                    self.__writefilev1(verify_frames, self.chip_v1["mode_verify"])
+            elif bt_version == '2.3':
+                with self.__phase('erase'):
+                    self.__erasechipv2()
+                with self.__phase('write'):
+                    self.__writefilev2(write_frames, self.chip_v2["mode_write"])
+                with self.__phase('verify'):
+                    self.__writefilev2(verify_frames, self.chip_v2["mode_verify"])
+            self.write_path = 'programmed'
+        if self.auto_start and self.log_file is None:
+            self.__exitbootloader(bt_version)
 
     def verify(self, firmware_bin):
-        self.__init_usb()
-        bt_version = self.__detect_bootloader_ver()
-        if bt_version == '1.1':
-            self.__identchipv1()
-            self.__writefilev1(firmware_bin, self.chip_v1["mode_verify"])
-            if self.log_file is None:
-                self.__exitbootloaderv1()
-        if bt_version == '2.3':
-            self.__identchipv2()
-            self.__writefilev2(firmware_bin, self.chip_v2["mode_verify"])
-            if self.log_file is None:
-                self.__exitbootloaderv2()
+        bt_version = self.__open()
+        frames = self.__encodefile(firmware_bin, bt_version)
+        with self.__phase('verify'):
+            if bt_version == '1.1':
+                self.__writefilev1(frames, self.chip_v1["mode_verify"])
+            if bt_version == '2.3':
+                self.__writefilev2(frames, self.chip_v2["mode_verify"])
+        if self.auto_start and self.log_file is None:
+            self.__exitbootloader(bt_version)
+
+    # verify the (start, stop) address ranges of the file, stop exclusive
+    # returns the FaultMap of the failing packets, only filled when keep_going is set
+    def verify_ranges(self, firmware_bin, ranges, keep_going=False):
+        bt_version = self.__open()
+        frames = self.__encodefile(firmware_bin, bt_version)
+        with self.__phase('verify'):
+            faults = self.__verifyranges(frames, bt_version, ranges, keep_going)
+        if self.auto_start and self.log_file is None:
+            self.__exitbootloader(bt_version)
+        return faults
 
     # erase: stay in bootloader mode?
-    def erase(self):
-        self.__init_usb()
-        bt_version = self.__detect_bootloader_ver()
-        if bt_version == '1.1':
-            self.__identchipv1()
-            self.__erasechipv1()
-        if bt_version == '2.3':
-            self.__identchipv2()
-            self.__erasechipv2()
+    # firmware_bin: erase only the sectors this image needs, None = the image of the session or the full span
+    def erase(self, firmware_bin=None):
+        bt_version = self.__open()
+        if firmware_bin is not None:
+            self.__loadimage(firmware_bin)
+        with self.__phase('erase'):
+            if bt_version == '1.1':
+                self.__erasechipv1()
+            if bt_version == '2.3':
+                self.__erasechipv2()
 
     def detect(self):
-        self.__init_usb()
-        bt_version = self.__detect_bootloader_ver()
-        if bt_version == '1.1':
-            self.__identchipv1()
-        if bt_version == '2.3':
-            self.__identchipv2()
+        self.__open()
+        return self.info()
 
     def start_app(self):
-        self.__init_usb()
-        bt_version = self.__detect_bootloader_ver()
+        if self.identified:
+            bt_version = self.bootloader_ver
+        else:
+            self.__init_usb()
+            bt_version = self.__detect_bootloader_ver()
+        self.__exitbootloader(bt_version)
+
+
+# frames of a FirmwareImage for one bootloader version and chip id, encoded on first use and cached
+# in image.frames, v1.1 frames are not scrambled and shared by all chips
+def encode_image(image, bt_version, chipid):
+    key = (bt_version, None if bt_version == '1.1' else chipid)
+    frames = image.frames.get(key)
+    if frames is None:
         if bt_version == '1.1':
-            self.__exitbootloaderv1()
-        if bt_version == '2.3':
-            self.__exitbootloaderv2()
+            frames = encode_v1(image.segments)
+        else:
+            frames = encode_v2(image.segments, chipid)
+        image.frames[key] = frames
+    return frames
+
+
+# timeout argument: KIND=MS with kind detect, erase, write or verify
+def __timeout_setting(txt):
+    kind, _, value = txt.partition('=')
+    if kind not in CHflasher.timeouts or not value.isdigit():
+        raise argparse.ArgumentTypeError('timeout must be KIND=MS, KIND one of ' + ', '.join(CHflasher.timeouts))
+    return kind, int(value)
+
+
+# patch argument: OFFSET=HEX
+def __patch_setting(txt):
+    try:
+        return parse_patch(txt)
+    except ImageError as ex:
+        raise argparse.ArgumentTypeError(str(ex))
+
+
+# address range argument: START-STOP, stop exclusive
+def __address_range(txt):
+    try:
+        start, stop = (int(x, 0) for x in txt.split('-'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('range must be START-STOP, e.g. 0x2800-0x3000')
+    if stop <= start:
+        raise argparse.ArgumentTypeError('wrong range, stop <= start')
+    return start, stop
+
+
+# byte value 0..255, as in gen_data.py, but rejected by argparse
+def __uint8_t(txt):
+    try:
+        x = int(txt, 0)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid value ' + txt)
+    if x > 0xFF or x < 0:
+        raise argparse.ArgumentTypeError('Value not in allowed range!')
+    return x
+
+
+# every CH55x bootloader on the bus, a device that can not be opened (no access, busy) gets an
+# UnopenedTransport, raises CHflasherError without pyusb
+def find_usb_transports():
+    if usb is None:
+        raise CHflasherError('pyusb is not installed, install it via pip install pyusb')
+    transports = []
+    for dev in usb.core.find(find_all=True, idVendor=0x4348, idProduct=0x55e0):
+        try:
+            transports.append(UsbTransport(dev))
+        except CHflasherError as ex:
+            transports.append(UnopenedTransport(UsbTransport.location_of(dev),
+                                                'USB open failed: ' + str(ex).splitlines()[0]))
+    return transports
+
+
+# runs one operation ('write', 'verify', 'erase', 'detect' or 'start_app') or a list of them on all
+# transports in parallel, the steps of a list run in one session per device, as in the command line
+# every device gets its own CHflasher session, settings is a dict of CHflasher attributes
+# applied to each session, log, capture and profile are the base names of the per device log, capture
+# and profile files
+# returns {location: result} with result['result'] == 'ok' on success
+def gang_run(transports, operation, firmware_bin=None, settings=None, log=None, workers=None, capture=None,
+             profile=None):
+
+    def run_one(transport):
+        flash = CHflasher(transport)
+        flash.tag = transport.location
+        for name, value in (settings or {}).items():
+            setattr(flash, name, value)
+        if log:
+            root, ext = os.path.splitext(log)
+            flash.set_logger(True, root + '_' + transport.location + ext)
+        if capture:
+            root, ext = os.path.splitext(capture)
+            flash.set_capture(root + '_' + transport.location + ext)
+        if profile:
+            flash.profiler = Profiler()
+        t_start = monotonic()
+        result = 'ok'
+        steps = [operation] if isinstance(operation, str) else list(operation)
+        if len(steps) > 1:
+            flash.auto_start = False
+        try:
+            for step in steps:
+                if step in ('write', 'verify', 'erase'):
+                    getattr(flash, step)(firmware_bin)
+                else:
+                    getattr(flash, step)()
+            if len(steps) > 1 and ('write' in steps or 'verify' in steps) and 'start_app' not in steps and not log:
+                flash.start_app()
+        except CHflasherError as ex:
+            result = str(ex)
+        except Exception as ex:
+            result = 'USB error: ' + str(ex)
+        flash.close_logger()
+        flash.close_capture()
+        if profile:
+            root, ext = os.path.splitext(profile)
+            flash.profiler.write(root + '_' + transport.location + ext, flash.profile_labels())
+        return transport.location, {
+            'result': result,
+            'chipid': flash.chipid,
+            'bootloader': flash.bootloader_ver,
+            'write_path': flash.write_path,
+            'retries': flash.retry_count,
+            'time_s': monotonic() - t_start,
+        }
+
+    if not transports:
+        return {}
+    if isinstance(firmware_bin, str):
+        # loaded once, all sessions share the image
+        try:
+            firmware_bin = load_image(firmware_bin)
+        except (OSError, ImageError) as ex:
+            print('Error: can not load ' + firmware_bin + ': ' + str(ex))
+            return {}
+    with ThreadPoolExecutor(max_workers=workers or len(transports)) as pool:
+        return dict(pool.map(run_one, transports))
+
+
+def print_gang_results(results):
+    print(CHflasher.txt_sep)
+    print('{:<12} {:<6} {:<5} {:<11} {:>7} {:>8}  {}'.format('port', 'chip', 'boot', 'path', 'retries', 'time s',
+                                                             'result'))
+    print(CHflasher.txt_sep)
+    for location in sorted(results):
+        r = results[location]
+        print('{:<12} {:<6} {:<5} {:<11} {:>7} {:>8.2f}  {}'.format(
+            location, 'CH5' + str(r['chipid'] - 30) if r['chipid'] else '-', r['bootloader'] or '-',
+            r['write_path'] or '-', r['retries'], r['time_s'], r['result']))
+    print(CHflasher.txt_sep)
+    failed = len([r for r in results.values() if r['result'] != 'ok'])
+    print(str(len(results)) + ' devices, ' + str(failed) + ' failed')
 
 
 def __main(argv, flash):
     parser = argparse.ArgumentParser(description="CH55x USB bootloader flash tool.")
     parser.add_argument('--version',  action='store_true', help="Show version.")
-    parser.add_argument('-f', '--file', type=str, default='', help="The target file to be flashed.")
-    group = parser.add_mutually_exclusive_group()
-    group.add_argument('-w', '--write', action='store_true', default=False, help="Write file to flash")
-    group.add_argument('-v', '--verify', action='store_true', default=False,  help="Verify flash against the provided file.")
-    group.add_argument('-d', '--detect', action='store_true', default=False, help="Detect chip and bootloader version.")
-    group.add_argument('-e', '--erase', action='store_true', default=False, help="Erase flash.")
+    parser.add_argument('-f', '--file', type=str, default='', help="The target file to be flashed (.bin or .ihx).")
+    parser.add_argument('-d', '--detect', action='store_true', default=False, help="Detect chip and bootloader version.")
+    parser.add_argument('-e', '--erase', action='store_true', default=False, help="Erase flash.")
+    parser.add_argument('-w', '--write', action='store_true', default=False, help="Write file to flash")
+    parser.add_argument('-v', '--verify', action='store_true', default=False,  help="Verify flash against the provided file.")
     parser.add_argument('-s', '--start_app', action='store_true', default=False, help="Reset and start application.")
     parser.add_argument('--log', type=str, default=None, help="Log usb opeations to file.")
+    parser.add_argument('--capture', type=str, default=None,
+                        help="Record the raw USB frames into a pcap file, render it with ch55x_capture.py.")
+    parser.add_argument('--window', type=int, default=1,
+                        help="Write/verify packets kept in flight, 1 = lock-step (default).")
+    parser.add_argument('--sparse', action='store_true', default=False,
+                        help="Do not write packets that already match the erased flash.")
+    parser.add_argument('--sparse-verify', choices=('erased', 'skip'), default='erased',
+                        help="Skipped packets are verified as erased (default) or not verified at all.")
+    parser.add_argument('--skip-identical', action='store_true', default=False,
+                        help="Verify first, skip erase and write if the device already holds the file.")
+    parser.add_argument('--erased-value', type=__uint8_t, default=0xff,
+                        help="Value of an erased flash byte 0-255 (default 0xff).")
+    parser.add_argument('--range', type=__address_range, action='append', default=None,
+                        help="Verify only this address range START-STOP (stop exclusive, with -v), can be repeated.")
+    parser.add_argument('--keep-going', action='store_true', default=False,
+                        help="Range verify: do not stop at the first failure, print a fault map instead.")
+    parser.add_argument('--all', action='store_true', default=False,
+                        help="Gang mode: run the operation on every connected CH55x in parallel.")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Devices programmed at the same time in gang mode (default: all).")
+    parser.add_argument('--patch', type=__patch_setting, action='append', default=[],
+                        help="Patch the image: OFFSET=HEX bytes, can be repeated.")
+    parser.add_argument('--patch-csv', type=str, default=None,
+                        help="Per unit patches, csv with the offsets in the header and one row per unit.")
+    parser.add_argument('--unit', type=str, default=None, help="Row of the --patch-csv file to apply.")
+    parser.add_argument('--fused', type=int, nargs='?', const=0, default=None,
+                        help="Verify every erase sector (or every N packets) right after writing it, "
+                             "stop at the first failure.")
+    parser.add_argument('--full-erase', action='store_true', default=False,
+                        help="Erase the whole fixed span (up to the image end if larger), "
+                             "not only the sectors the image needs.")
+    parser.add_argument('--timeout', type=__timeout_setting, action='append', default=[],
+                        help="Transfer timeout KIND=MS for detect, erase, write or verify, can be repeated.")
+    parser.add_argument('--retries', type=int, default=CHflasher.retries,
+                        help="Retries of a timed out packet (default 2).")
+    parser.add_argument('--retry-backoff', type=float, default=CHflasher.retry_backoff,
+                        help="Wait before the first retry in seconds, doubled for every further one.")
+    parser.add_argument('--profile', type=str, default=None,
+                        help="Time the phases and USB round trips, write them as json or .prom (Prometheus) file.")
+    parser.add_argument('--profile-cpu', type=str, default=None,
+                        help="Write a cProfile dump of the host side CPU time.")
     args = parser.parse_args()
 
     firmware_bin = None
 
     if args.version:
         flash.show_info()
+    if (args.range or args.keep_going) and not args.verify:
+        print('Error: --range and --keep-going need -v')
+        sys.exit(2)
+    if args.keep_going and not args.range:
+        print('Error: --keep-going needs --range')
+        sys.exit(2)
+    if args.range and args.all:
+        print('Error: --range can not be used in gang mode')
+        sys.exit(2)
+    settings = {
+        'window': args.window,
+        'sparse': args.sparse,
+        'sparse_verify': args.sparse_verify,
+        'erased_value': args.erased_value,
+        'verify_first': args.skip_identical,
+        'timeouts': dict(CHflasher.timeouts, **dict(args.timeout)),
+        'retries': args.retries,
+        'retry_backoff': args.retry_backoff,
+        'full_erase': args.full_erase,
+        'fused': args.fused,
+        'patches': list(args.patch),
+    }
+    if args.patch_csv:
+        try:
+            units = dict(load_patch_csv(args.patch_csv))
+        except (OSError, ImageError) as ex:
+            print('Error: ' + str(ex))
+            sys.exit(2)
+        if args.unit not in units:
+            print('Error: unit ' + str(args.unit) + ' not found in ' + args.patch_csv + ', select one with --unit')
+            sys.exit(2)
+        settings['patches'] += units[args.unit]
+    if args.all:
+        steps = [name for name in ('detect', 'erase', 'write', 'verify', 'start_app') if getattr(args, name)]
+        if not steps:
+            print('Error: gang mode needs at least one of -d, -e, -w, -v or -s')
+            sys.exit(2)
+        try:
+            transports = find_usb_transports()
+        except CHflasherError as ex:
+            print('Error: ' + str(ex))
+            sys.exit(2)
+        results = gang_run(transports, steps, args.file or None, settings, args.log, args.workers,
+                           args.capture, args.profile)
+        print_gang_results(results)
+        if not results or any(r['result'] != 'ok' for r in results.values()):
+            sys.exit(1)
+        return
     if args.log:
         flash.set_logger(True, args.log)
+    if args.capture:
+        flash.set_capture(args.capture)
+    for name, value in settings.items():
+        setattr(flash, name, value)
     if args.file:
         firmware_bin = args.file
-    if args.write:
-        flash.write(firmware_bin)
-    if args.verify:
-        flash.verify(firmware_bin)
-    if args.detect:
-        flash.detect()
-    if args.erase:
-        flash.erase()
-    if args.start_app:
-        flash.start_app()
-    if args.detect:
-        flash.detect()
-
-    # close log file if used
-    flash.close_logger()
+    if args.profile:
+        flash.profiler = Profiler()
+    cpu_profile = None
+    if args.profile_cpu:
+        cpu_profile = cProfile.Profile()
+        cpu_profile.enable()
+    # one session for all steps, they run in the order -d -e -w -v -s
+    flash.auto_start = False
+    result = 0
+    try:
+        if args.detect:
+            flash.detect()
+        if args.erase:
+            flash.erase(firmware_bin)
+        if args.write:
+            flash.write(firmware_bin)
+        if args.verify and args.range:
+            faults = flash.verify_ranges(firmware_bin, args.range, args.keep_going)
+            if len(faults):
+                result = 1
+        elif args.verify:
+            flash.verify(firmware_bin)
+        # without the logger a write or verify ends with the application started, as before
+        if args.start_app or ((args.write or args.verify) and args.log is None and not result):
+            flash.start_app()
+    except CHflasherError:
+        result = 1
+
+    if flash.retry_count:
+        print("USB retries: " + str(flash.retry_count) + " (" +
+              ', '.join('0x{:02x}: {}'.format(cmd, n) for cmd, n in sorted(flash.retry_counts.items())) + ")")
+    # close log and capture files if used
+    flash.close()
+    if cpu_profile is not None:
+        cpu_profile.disable()
+        cpu_profile.dump_stats(args.profile_cpu)
+        print("CPU profile saved: " + args.profile_cpu)
+    if flash.profiler is not None:
+        flash.profiler.print_summary()
+        flash.profiler.write(args.profile, flash.profile_labels())
+        print("Profile saved: " + args.profile)
+    if result:
+        sys.exit(result)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+    Host side throughput benchmark for chflasher.py
+    Runs the complete write cycle (detect, erase, write, verify) against the
+    bootloader emulator from ch55x_sim.py for a range of image sizes and reports
+    packets/s, bytes/s and the wall time of every phase.
+"""
+
+import sys
+import os
+import io
+import json
+import random
+import argparse
+import tempfile
+import contextlib
+import time
+
+from chflasher import CHflasher, CHflasherError
+from ch55x_sim import SimCH55x, SimTransport
+
+example_text = '''--------------------------------------------------------------------------------
+Example:
+
+ benchmark the default 1..60 KB sweep on the v2.3 protocol:
+
+ python3 chflasher_bench.py
+
+ emulate a 1 ms USB turnaround and write the results as json:
+
+ python3 chflasher_bench.py --latency 0.001 --sizes 1,28,60 --json bench.json
+'''
+
+# command byte -> phase, per bootloader version
+phases = {
+    '2.3': {0xa1: 'detect', 0xa7: 'detect', 0xa3: 'detect', 0xa4: 'erase', 0xa5: 'write', 0xa6: 'verify'},
+    '1.1': {0xa1: 'detect', 0xa2: 'detect', 0xbb: 'detect', 0xa6: 'erase', 0xa9: 'erase', 0xa8: 'write',
+            0xa7: 'verify'},
+}
+phase_names = ('detect', 'erase', 'write', 'verify')
+
+
+def __size_list(txt):
+    return [int(x, 0) for x in txt.split(',') if x]
+
+
+def phase_times(trace, bootloader):
+    # wall time of a phase: first OUT transfer to the last reply of that phase
+    spans = {}
+    for t_out, t_in, cmd, _ in trace:
+        name = phases[bootloader].get(cmd)
+        if name is None or t_in is None:
+            continue
+        first, last = spans.get(name, (t_out, t_in))
+        spans[name] = (min(first, t_out), max(last, t_in))
+    return {name: spans[name][1] - spans[name][0] if name in spans else 0.0 for name in phase_names}
+
+
+def run_once(image, args):
+    device = SimCH55x(chipid=args.chip, bootloader=args.bootloader,
+                      fail_verify_from=args.fail_verify_from, packet_time=args.packet_time)
+    transport = SimTransport(device, latency=args.latency)
+    flasher = CHflasher(transport)
+    flasher.window = args.window
+    flasher.sparse = args.sparse
+    fd, file_name = tempfile.mkstemp(suffix='.bin')
+    result = 'ok'
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(image)
+        t_start = time.monotonic()
+        with contextlib.redirect_stdout(io.StringIO()):
+            try:
+                flasher.write(file_name)
+            except CHflasherError as ex:
+                result = str(ex)
+        total = time.monotonic() - t_start
+    finally:
+        os.remove(file_name)
+    return {
+        'size': len(image),
+        'result': result,
+        'packets': len(transport.trace),
+        'bytes_out': transport.bytes_out,
+        'bytes_in': transport.bytes_in,
+        'total_s': total,
+        'packets_per_s': len(transport.trace) / total if total else 0.0,
+        'bytes_per_s': len(image) / total if total else 0.0,
+        'phases_s': phase_times(transport.trace, args.bootloader),
+    }
+
+
+def run(args):
+    rnd = random.Random(args.seed)
+    results = []
+    for kb in args.sizes:
+        size = kb * 1024
+        padding = size * args.padding // 100
+        image = bytes(rnd.getrandbits(8) for _ in range(size - padding)) + b'\xff' * padding
+        runs = [run_once(image, args) for _ in range(args.repeat)]
+        # keep the fastest of the repeats, the others are mostly scheduler noise
+        results.append(min(runs, key=lambda r: r['total_s']))
+    return results
+
+
+def print_results(results):
+    print('-' * 96)
+    print('{:>7} {:>6} {:>9} {:>10} {:>9} {:>9} {:>9} {:>9} {:>9}  {}'.format(
+        'size', 'pkts', 'pkt/s', 'B/s', 'total ms', 'detect', 'erase', 'write', 'verify', 'result'))
+    print('-' * 96)
+    for r in results:
+        ph = r['phases_s']
+        print('{:>7} {:>6} {:>9.0f} {:>10.0f} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}  {}'.format(
+            r['size'], r['packets'], r['packets_per_s'], r['bytes_per_s'], r['total_s'] * 1000,
+            ph['detect'] * 1000, ph['erase'] * 1000, ph['write'] * 1000, ph['verify'] * 1000, r['result']))
+    print('-' * 96)
+
+
+def __main(argv):
+    parser = argparse.ArgumentParser(description="CH55x flasher throughput benchmark.",
+                                     epilog=example_text,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=__size_list, default=[1, 2, 4, 8, 16, 28, 32, 48, 60],
+                        help="Comma separated image sizes in KB.")
+    parser.add_argument('--bootloader', choices=('1.1', '2.3'), default='2.3', help="Emulated bootloader version.")
+    parser.add_argument('--chip', type=lambda x: int(x, 0), default=0x59, help="Emulated chip id.")
+    parser.add_argument('--latency', type=float, default=0.0, help="USB turnaround per transfer in seconds.")
+    parser.add_argument('--packet-time', type=float, default=0.0, help="Device processing time per packet in seconds.")
+    parser.add_argument('--window', type=int, default=1, help="Write/verify packets kept in flight.")
+    parser.add_argument('--sparse', action='store_true', default=False, help="Skip packets matching erased flash.")
+    parser.add_argument('--padding', type=int, default=0, help="Percentage of the image padded with 0xff.")
+    parser.add_argument('--fail-verify-from', type=lambda x: int(x, 0), default=None,
+                        help="Inject 0xF5 verify replies from this address upward.")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per size, the fastest one is reported.")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the random image content.")
+    parser.add_argument('--json', type=str, default=None, help="Write the results to a json file.")
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('Results saved: ' + args.json)
+
+
+if __name__ == "__main__":
+    __main(sys.argv[1:])
@@ -7,8 +7,8 @@
 
 import sys
 import os
-import getopt
 import random as rnd
+import hashlib
 import argparse
 
 
@@ -23,8 +23,20 @@ Example:
  generate am array of 512 zeros:
  
  python3 gen_data_py --val 0x00 -l 512 -o array_of_zeros.h
+
+ the same random array on every run:
+
+ python3 gen_data.py --rnd --seed 1 -l 8192 -o array.h
+
+ keep the file (and its timestamp) if it was generated with the same parameters:
+
+ python3 gen_data.py --cache --val 0x00 -l 24000 -o test_array.h
 '''
 
+# bump when the generated layout changes, invalidates all cache stamps
+FORMAT_VERSION = 1
+STAMP = "// gen_data {digest}\n"
+
 
 def __uint8_t(x):
     x = int(x, 0)
@@ -35,39 +47,75 @@ def __uint8_t(x):
         return x
 
 
-def __gen_rand(start, end, num):
-    res = []
-    for j in range(num): 
-        res.append(rnd.randint(start, end)) 
-    return res 
-
-
-def __gen_array(mode, length, value, filename):
-
-    with open(filename, "w") as out_file:
-        inc_name = os.path.basename(filename).split(".")[0]
-        print("#ifndef __{name}_H_".format(name=inc_name.upper()), file=out_file)
-        print("#define __{name}_H_".format(name=inc_name.upper()), file=out_file)
-        print("\r\n#include \"sdcc_int.h\"\r\n", file=out_file)
-        print("const uint8_t data[{len}] = {{".format(len=length), file=out_file)
-        if mode == 'rnd':
-            table = __gen_rand(0, 255, length)
-        elif mode == 'lst':
-            table = range(0, length+1)
-        elif mode == 'val' and value:
-            table = [value] * (length+1)
-        for i in range(length):
-            value = table[i] & 0xFF
-            print("0x{v:02x}".format(v=value), file=out_file, end='')
-            if i < length-1 :
-                print(", ", file=out_file, end='')
-            else:
-                print("\r\n", file=out_file, end='')
-            if (i % 10) == 9:
-                print("\n", file=out_file, end='')
-        print("};\n", file=out_file)
-        print("#endif", file=out_file)
-    print("Array of " + str(length) + " bytes created in file " + out_file.name)
+def __gen_rand(num, seed=None):
+    if seed is None:
+        return os.urandom(num)
+    return rnd.Random(seed).randbytes(num)
+
+
+def __gen_table(mode, length, value, seed=None):
+    if mode == 'rnd':
+        return __gen_rand(length, seed)
+    if mode == 'lst':
+        return bytes(range(256)) * (length // 256) + bytes(range(length % 256))
+    return bytes([value]) * length
+
+
+def __format_table(table):
+    # every value is "0xNN, ", 10 values per line, the last separator is "\r\n"
+    length = len(table)
+    if not length:
+        return b''
+    rows = (length + 9) // 10
+    hex_digits = (bytes(table) + bytes(10 * rows - length)).hex().encode()
+    # all lines from one template, then the two digits of every column filled in
+    out = bytearray(b'0x00, ' * 10 + b'\n') * rows
+    for col in range(10):
+        out[6 * col + 2::61] = hex_digits[2 * col::20]
+        out[6 * col + 3::61] = hex_digits[2 * col + 1::20]
+    end = 61 * ((length - 1) // 10) + 6 * ((length - 1) % 10) + 6
+    out[end - 2:end] = b'\r\n'
+    if length % 10:
+        del out[end:]
+    return out
+
+
+def __stamp(mode, length, value, seed, inc_name):
+    params = "{v}|{m}|{l}|{val}|{s}|{n}".format(v=FORMAT_VERSION, m=mode, l=length, val=value, s=seed, n=inc_name)
+    return STAMP.format(digest=hashlib.sha256(params.encode()).hexdigest()[:16])
+
+
+def __read_stamp(filename):
+    try:
+        with open(filename, "r") as in_file:
+            return in_file.readline()
+    except OSError:
+        return None
+
+
+def __gen_array(mode, length, value, filename, seed=None, cache=False):
+
+    inc_name = os.path.basename(filename).split(".")[0]
+    header = ""
+    if cache:
+        if mode == 'rnd' and seed is None:
+            print("Random values without --seed can not be cached, regenerating")
+        else:
+            header = __stamp(mode, length, value, seed, inc_name)
+            if __read_stamp(filename) == header:
+                print("Array of " + str(length) + " bytes in file " + filename + " is up to date")
+                return False
+    header += "#ifndef __{name}_H_\n".format(name=inc_name.upper())
+    header += "#define __{name}_H_\n".format(name=inc_name.upper())
+    header += "\r\n#include \"sdcc_int.h\"\r\n\n"
+    header += "const uint8_t data[{len}] = {{\n".format(len=length)
+    body = __format_table(__gen_table(mode, length, value, seed))
+    with open(filename, "wb") as out_file:
+        out_file.write(header.encode())
+        out_file.write(body)
+        out_file.write(b"};\n\n#endif\n")
+    print("Array of " + str(length) + " bytes created in file " + filename)
+    return True
 
 
 def __main(argv):
@@ -81,14 +129,17 @@ def __main(argv):
     group.add_argument('--val', type=__uint8_t, help="Populate array with one value.")
     parser.add_argument('-l', '--length', default=0, required=True, type=int, help="Length of the array in bytes.")
     parser.add_argument('-o', '--out', required=True, type=str, help="Output file name.")
+    parser.add_argument('-s', '--seed', default=None, type=int, help="Seed for reproducible random values.")
+    parser.add_argument('-c', '--cache', action='store_true', default=False,
+                        help="Leave the file untouched if it was generated with the same parameters.")
     args = parser.parse_args()
 
     if args.rnd:
-        __gen_array('rnd', args.length, None, args.out)
+        __gen_array('rnd', args.length, None, args.out, args.seed, args.cache)
     if args.lst:
-        __gen_array('lst', args.length, None, args.out)
+        __gen_array('lst', args.length, None, args.out, None, args.cache)
     if args.val is not None:
-        __gen_array('val', args.length, args.val, args.out)
+        __gen_array('val', args.length, args.val, args.out, None, args.cache)
 
 
 if __name__ == "__main__":
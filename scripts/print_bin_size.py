@@ -1,24 +1,221 @@
 #!/usr/bin/env python3
+"""
+    Firmware layout analyzer, run at the end of the build.
+    Reads the .bin or .ihx image and the sdcc linker .map next to it and
+    reports the occupancy against the code size, the used erase sectors,
+    the largest symbols in code memory and the write/verify packet count
+    with the predicted flashing time, with and without skipping blank
+    packets (--sparse). Several files or whole sweep directories can be
+    analyzed in one run, they are listed side by side.
+"""
+
 import sys
 import os
-import getopt
+import re
+import glob
+import json
+import argparse
+from collections import namedtuple
+from ch55x_image import ImageError, load_image
+from ch55x_frames import encode_v1, encode_v2
+
+# code_size of build.sh
+CODE_SIZE = 0xEFFF
+SECTOR_SIZE = 1024
+# smallest sector count the v2.3 erase command accepts
+MIN_ERASE_SECTORS = 8
+# USB round trip of one write/verify packet in seconds, used without a --profile file
+PACKET_LATENCY = 0.001
+# write/verify command bytes per bootloader version
+commands = {'2.3': (0xa5, 0xa6), '1.1': (0xa8, 0xa7)}
+
+example_text = '''--------------------------------------------------------------------------------
+Example:
+
+ analyze the build output, the map file is taken from CH559_verify_test.map:
+
+ python3 scripts/print_bin_size.py -i CH559_verify_test.bin
+
+ compare all images of a build sweep, packet times taken from a chflasher --profile run:
+
+ python3 scripts/print_bin_size.py sweep/ --profile profile.json
+'''
+
+Area = namedtuple('Area', 'name addr size attributes symbols')
+
+
+def parse_map(lines):
+    """ areas of a sdcc (sdld) linker map, every one with its [(address, symbol, module)] """
+    areas = []
+    symbols = None
+    for line in lines:
+        m = re.match(r'^(\S+)\s+([0-9A-Fa-f]{4,8})\s+([0-9A-Fa-f]{4,8})\s+=\s+\d+\.\s+bytes\s+\(([^)]*)\)', line)
+        if m:
+            symbols = []
+            areas.append(Area(m.group(1), int(m.group(2), 16), int(m.group(3), 16),
+                              tuple(x.strip() for x in m.group(4).split(',')), symbols))
+            continue
+        m = re.match(r'^\s+(?:[A-Z]:\s+)?([0-9A-Fa-f]{4,8})\s+(\S+)(?:\s+(\S+))?\s*$', line)
+        if m and symbols is not None:
+            symbols.append((int(m.group(1), 16), m.group(2), m.group(3) or ''))
+    return areas
+
+
+def code_blobs(areas):
+    """ [(size, address, symbol, module, area)] of the code memory symbols, largest first """
+    blobs = []
+    for area in areas:
+        if 'CODE' not in area.attributes or not area.size:
+            continue
+        end = area.addr + area.size
+        # the size of a symbol reaches to the next one in its area, the last one to the area end
+        symbols = sorted(s for s in area.symbols if area.addr <= s[0] < end)
+        for (addr, name, module), next_addr in zip(symbols, [s[0] for s in symbols[1:]] + [end]):
+            if next_addr > addr:
+                blobs.append((next_addr - addr, addr, name, module, area.name))
+    return sorted(blobs, reverse=True)
+
+
+def packet_latencies(profile_file, bootloader):
+    """ p50 round trip of the write and verify packets of a chflasher --profile json file """
+    with open(profile_file) as f:
+        stats = json.load(f)['commands']
+    latencies = []
+    for cmd in commands[bootloader]:
+        s = stats.get('0x{:02x}'.format(cmd))
+        latencies.append(s['p50'] if s else PACKET_LATENCY)
+    return tuple(latencies)
+
+
+def analyze(file_name, map_file=None, code_size=CODE_SIZE, bootloader='2.3', latencies=None, erased_value=0xff):
+    """ layout and flashing estimate of one image, map_file None = the .map next to it if there is one """
+    image = load_image(file_name)
+    if bootloader == '1.1':
+        frames = encode_v1(image.segments)
+    else:
+        frames = encode_v2(image.segments, 0)
+    write_latency, verify_latency = latencies or (PACKET_LATENCY, PACKET_LATENCY)
+    packets = len(frames)
+    blank = len(frames.blank_frames(erased_value))
+    sectors = sorted({x for addr, data in image.segments if len(data)
+                      for x in range(addr // SECTOR_SIZE, (addr + len(data) - 1) // SECTOR_SIZE + 1)})
+    if map_file is None:
+        candidate = os.path.splitext(file_name)[0] + '.map'
+        map_file = candidate if os.path.exists(candidate) else None
+    blobs = []
+    if map_file is not None:
+        with open(map_file) as f:
+            blobs = code_blobs(parse_map(f))
+    return {
+        'file': file_name,
+        'map': map_file,
+        'file_size': os.path.getsize(file_name),
+        'used': len(image),
+        'extent': image.size,
+        'code_size': code_size,
+        'occupancy': image.size / code_size,
+        'segments': len(image.segments),
+        'sectors': len(sectors),
+        'erase_sectors': max(-(-image.size // SECTOR_SIZE), MIN_ERASE_SECTORS) if bootloader == '2.3' else len(sectors),
+        'packets': packets,
+        'blank_packets': blank,
+        # write + verify, with --sparse the blank packets are not written but still verified as erased
+        'time_s': packets * (write_latency + verify_latency),
+        'sparse_time_s': (packets - blank) * write_latency + packets * verify_latency,
+        'sparse_skip_time_s': (packets - blank) * (write_latency + verify_latency),
+        'blobs': [{'size': size, 'addr': addr, 'symbol': name, 'module': module, 'area': area}
+                  for size, addr, name, module, area in blobs],
+    }
+
+
+def print_report(r, top=5):
+    print("--------------------------------------------")
+    print(r['file'])
+    print("Output file size = " + str(r['file_size']) + " bytes")
+    print("Code: {} bytes in {} segment(s), end 0x{:04x}, {:.1f}% of 0x{:04X}, {} bytes free".format(
+        r['used'], r['segments'], r['extent'], r['occupancy'] * 100, r['code_size'], r['code_size'] - r['extent']))
+    print("Sectors: {} of 1 KiB used, erase count {}".format(r['sectors'], r['erase_sectors']))
+    print("Packets: {} write + {} verify, {} blank".format(r['packets'], r['packets'], r['blank_packets']))
+    print("Estimate: {:.0f} ms, --sparse {:.0f} ms, --sparse --sparse-verify skip {:.0f} ms".format(
+        r['time_s'] * 1000, r['sparse_time_s'] * 1000, r['sparse_skip_time_s'] * 1000))
+    if r['blobs']:
+        print("Largest symbols (" + r['map'] + "):")
+        for b in r['blobs'][:top]:
+            print("  {:>6} bytes  0x{:04x}  {:<24} {:<12} {}".format(b['size'], b['addr'], b['symbol'], b['module'],
+                                                                     b['area']))
+    print("--------------------------------------------")
+
+
+def print_table(results):
+    print('{:>7} {:>6} {:>7} {:>7} {:>7} {:>9} {:>9}  {}'.format(
+        'used', 'code%', 'sectors', 'packets', 'blank', 'est ms', 'sparse ms', 'file'))
+    for r in results:
+        print('{:>7} {:>6.1f} {:>7} {:>7} {:>7} {:>9.0f} {:>9.0f}  {}'.format(
+            r['used'], r['occupancy'] * 100, r['sectors'], r['packets'], r['blank_packets'], r['time_s'] * 1000,
+            r['sparse_time_s'] * 1000, r['file']))
+    print("--------------------------------------------")
+
+
+def input_files(names):
+    """ files as given, directories expand to the .bin and .ihx files in them """
+    files = []
+    for name in names:
+        if os.path.isdir(name):
+            files += sorted(glob.glob(os.path.join(name, '*.bin')) + glob.glob(os.path.join(name, '*.ihx')))
+        else:
+            files.append(name)
+    return files
+
 
 def main(argv):
-    try:
-        opts, args = getopt.getopt(argv, "i:")
-    except getopt.GetoptError as err:
-        print(err)
+    parser = argparse.ArgumentParser(description="Firmware layout analyzer and flashing time estimate.",
+                                     epilog=example_text,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='*', help="Images (.bin, .ihx) or directories of them.")
+    parser.add_argument('-i', '--input', action='append', default=[], help="Image file, can be repeated.")
+    parser.add_argument('--map', type=str, default=None, help="Linker map of a single image (default: FILE.map).")
+    parser.add_argument('--code-size', type=lambda x: int(x, 0), default=CODE_SIZE,
+                        help="Available code memory (default 0xEFFF).")
+    parser.add_argument('--bootloader', choices=('1.1', '2.3'), default='2.3', help="Packet layout of the estimate.")
+    parser.add_argument('--profile', type=str, default=None,
+                        help="chflasher --profile json file, the per packet latency is taken from it.")
+    parser.add_argument('--latency', type=float, default=PACKET_LATENCY * 1000,
+                        help="Round trip of one packet in ms, without --profile (default 1).")
+    parser.add_argument('--top', type=int, default=5, help="Largest symbols listed.")
+    parser.add_argument('--json', type=str, default=None, help="Write the results to a json file.")
+    args = parser.parse_args(argv)
+
+    files = input_files(args.input + args.files)
+    if not files:
+        print('Error: too few arguments!')
         sys.exit(2)
-    for opt, arg in opts:
-        if opt in '-i':
-            input_file = arg
-        else:
-            assert False, "unhandled option"
+    latencies = (args.latency / 1000, args.latency / 1000)
+    if args.profile:
+        try:
+            latencies = packet_latencies(args.profile, args.bootloader)
+        except (OSError, ValueError, KeyError) as ex:
+            print('Error: can not read ' + args.profile + ': ' + str(ex))
+            sys.exit(2)
+    results = []
+    for file_name in files:
+        try:
+            results.append(analyze(file_name, args.map if len(files) == 1 else None, args.code_size,
+                                   args.bootloader, latencies))
+        except (OSError, ImageError) as ex:
+            print('Error: ' + file_name + ': ' + str(ex))
+            sys.exit(2)
+        print_report(results[-1], args.top)
+    if len(results) > 1:
+        print_table(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+        print("Results saved: " + args.json)
+    too_big = [r['file'] for r in results if r['extent'] > r['code_size']]
+    if too_big:
+        print('Error: larger than the code size: ' + ', '.join(too_big))
+        sys.exit(1)
 
-        size = os.path.getsize(input_file)
-        print("--------------------------------------------")
-        print("Output file size = "+str(size)+" bytes")
-        print("--------------------------------------------")
 
 if __name__ == "__main__":
 
@@ -27,4 +224,3 @@ if __name__ == "__main__":
         sys.exit(2)
     else:
         main(sys.argv[1:])
-
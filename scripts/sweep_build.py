@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""
+    Builds a matrix of test firmware variants (array size x fill pattern) in parallel.
+    Every variant gets its own temporary copy of the sources and a test_array.h
+    from gen_data.py, compiled images are cached by the hash of the generated
+    header, the other sources and the compiler command.
+"""
+
+import sys
+import os
+import glob
+import json
+import shutil
+import hashlib
+import argparse
+import tempfile
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+PROJECT_NAME = 'CH559_verify_test'
+# compiler flags of build.sh
+FLAGS = '-mmcs51 --std-sdcc11 --model-large --xram-size 0x0800 --xram-loc 0x0600 --code-size 0xEFFF ' \
+        '-DFREQ_SYS=48000000'
+BUILD_CMD = 'sdcc -c {flags} main.c && sdcc main.rel {flags} -o {project}.ihx && ' \
+            'sdobjcopy -I ihex -O binary {project}.ihx {project}.bin'
+
+example_text = '''--------------------------------------------------------------------------------
+Example:
+
+ build all 0x00 and random arrays from 8000 to 28000 bytes on 8 cores:
+
+ python3 scripts/sweep_build.py --sizes 8000-28000:2000 --patterns 0x00,rnd -j 8
+
+ dry run of the matrix with a stub compiler, the "image" is the generated header:
+
+ python3 scripts/sweep_build.py --sizes 1000,2000 --build-cmd "cp test_array.h {project}.bin"
+
+ The build command runs in the variant directory and has to leave {project}.bin there,
+ {flags} and {project} are replaced with --flags and the project name.
+ The linker map {project}.map is kept next to every bin, analyze the whole sweep with:
+
+ python3 scripts/print_bin_size.py sweep/
+'''
+
+
+def __size_list(txt):
+    """ comma separated sizes, START-STOP:STEP ranges include STOP """
+    sizes = []
+    for item in txt.split(','):
+        if not item:
+            continue
+        if '-' in item:
+            rng, _, step = item.partition(':')
+            start, stop = (int(x, 0) for x in rng.split('-'))
+            sizes.extend(range(start, stop + 1, int(step, 0) if step else 1000))
+        else:
+            sizes.append(int(item, 0))
+    return sizes
+
+
+def __pattern_list(txt):
+    patterns = []
+    for item in txt.split(','):
+        if item in ('rnd', 'lst'):
+            patterns.append(item)
+        elif item:
+            value = int(item, 0)
+            if value < 0 or value > 0xff:
+                raise argparse.ArgumentTypeError('pattern value not in 0-255 range: ' + item)
+            patterns.append('0x{:02x}'.format(value))
+    return patterns
+
+
+def __gen_args(pattern, seed):
+    if pattern == 'rnd':
+        return ['--rnd', '--seed', str(seed)]
+    if pattern == 'lst':
+        return ['--lst']
+    return ['--val', pattern]
+
+
+def source_files(src_dir):
+    """ sources copied into every variant directory, the generated array excluded """
+    files = [os.path.join(src_dir, 'main.c')]
+    files += sorted(f for f in glob.glob(os.path.join(src_dir, '*.h')) if os.path.basename(f) != 'test_array.h')
+    return files
+
+
+def build_variant(variant):
+    """
+    Generates and compiles one variant, runs in a worker process.
+    variant: dict with size, pattern, seed, src_dir, out_dir, cache_dir, build_cmd, flags
+    """
+    size = variant['size']
+    pattern = variant['pattern']
+    name = '{}_{}_{}'.format(PROJECT_NAME, size, pattern)
+    result = {'size': size, 'pattern': pattern, 'bin': None, 'bin_size': 0, 'status': 'failed', 'key': None,
+              'time_s': 0.0, 'error': ''}
+    t_start = time.monotonic()
+    work_dir = tempfile.mkdtemp(prefix=name + '_')
+    try:
+        key = hashlib.sha256()
+        for f in source_files(variant['src_dir']):
+            shutil.copy(f, work_dir)
+            with open(f, 'rb') as src:
+                key.update(os.path.basename(f).encode() + b'\0' + src.read())
+        gen = subprocess.run([sys.executable, os.path.join(script_dir, 'gen_data.py'),
+                              '-l', str(size), '-o', 'test_array.h'] + __gen_args(pattern, variant['seed']),
+                             cwd=work_dir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        if gen.returncode:
+            result['error'] = gen.stdout.decode(errors='replace').strip()
+            return result
+        with open(os.path.join(work_dir, 'test_array.h'), 'rb') as header:
+            key.update(header.read())
+        key.update(variant['flags'].encode() + b'\0' + variant['build_cmd'].encode())
+        result['key'] = key.hexdigest()[:16]
+        cached = os.path.join(variant['cache_dir'], result['key'] + '.bin')
+        if os.path.exists(cached):
+            result['status'] = 'cached'
+        else:
+            cmd = variant['build_cmd'].format(flags=variant['flags'], project=PROJECT_NAME)
+            build = subprocess.run(cmd, shell=True, cwd=work_dir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            image = os.path.join(work_dir, PROJECT_NAME + '.bin')
+            if build.returncode or not os.path.exists(image):
+                # last line of the compiler output is usually the one that matters
+                lines = build.stdout.decode(errors='replace').strip().splitlines()
+                result['error'] = lines[-1] if lines else 'no ' + PROJECT_NAME + '.bin'
+                return result
+            # copy, then rename, so a parallel run never sees a partial file
+            # the linker map goes first, a cached bin always has its map next to it if there was one
+            link_map = os.path.join(work_dir, PROJECT_NAME + '.map')
+            if os.path.exists(link_map):
+                tmp = cached[:-4] + '.map.' + str(os.getpid())
+                shutil.copy(link_map, tmp)
+                os.replace(tmp, cached[:-4] + '.map')
+            tmp = cached + '.' + str(os.getpid())
+            shutil.copy(image, tmp)
+            os.replace(tmp, cached)
+            result['status'] = 'built'
+        result['bin'] = os.path.join(variant['out_dir'], name + '.bin')
+        shutil.copy(cached, result['bin'])
+        if os.path.exists(cached[:-4] + '.map'):
+            shutil.copy(cached[:-4] + '.map', result['bin'][:-4] + '.map')
+        result['bin_size'] = os.path.getsize(result['bin'])
+        return result
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        result['time_s'] = time.monotonic() - t_start
+
+
+def sweep(sizes, patterns, seed=0, jobs=None, src_dir=None, out_dir='sweep', cache_dir=None,
+          build_cmd=BUILD_CMD, flags=FLAGS):
+    """ builds every size x pattern variant, returns the results in matrix order """
+    src_dir = src_dir or os.path.dirname(script_dir)
+    cache_dir = cache_dir or os.path.join(out_dir, 'cache')
+    os.makedirs(out_dir, exist_ok=True)
+    os.makedirs(cache_dir, exist_ok=True)
+    variants = [{'size': size, 'pattern': pattern, 'seed': seed, 'src_dir': src_dir, 'out_dir': out_dir,
+                 'cache_dir': cache_dir, 'build_cmd': build_cmd, 'flags': flags}
+                for pattern in patterns for size in sizes]
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(build_variant, variants))
+
+
+def print_results(results):
+    print('-' * 80)
+    print('{:>7} {:>8} {:>7} {:>8} {:>8}  {}'.format('size', 'pattern', 'status', 'bin', 'time ms', 'file'))
+    print('-' * 80)
+    for r in results:
+        print('{:>7} {:>8} {:>7} {:>8} {:>8.0f}  {}'.format(
+            r['size'], r['pattern'], r['status'], r['bin_size'], r['time_s'] * 1000, r['bin'] or r['error']))
+    print('-' * 80)
+    counts = {s: sum(1 for r in results if r['status'] == s) for s in ('built', 'cached', 'failed')}
+    print('{built} built, {cached} cached, {failed} failed'.format(**counts))
+
+
+def __main(argv):
+    parser = argparse.ArgumentParser(description="Parallel test firmware matrix builder.",
+                                     epilog=example_text,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=__size_list, default=[24000],
+                        help="Array sizes, comma separated, START-STOP:STEP for ranges.")
+    parser.add_argument('--patterns', type=__pattern_list, default=['0x00'],
+                        help="Comma separated fill values, rnd or lst.")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the rnd pattern.")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="Parallel builds, default: cpu count.")
+    parser.add_argument('-o', '--out', type=str, default='sweep', help="Output directory of the bin files.")
+    parser.add_argument('--cache', type=str, default=None, help="Image cache directory, default: OUT/cache.")
+    parser.add_argument('--src', type=str, default=None, help="Project directory, default: the repository root.")
+    parser.add_argument('--build-cmd', type=str, default=BUILD_CMD, help="Compiler command of one variant.")
+    parser.add_argument('--flags', type=str, default=FLAGS, help="Compiler flags, replace {flags}.")
+    parser.add_argument('--json', type=str, default=None, help="Write the results to a json file.")
+    args = parser.parse_args(argv)
+
+    results = sweep(args.sizes, args.patterns, args.seed, args.jobs, args.src, args.out, args.cache,
+                    args.build_cmd, args.flags)
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('Results saved: ' + args.json)
+    if any(r['status'] == 'failed' for r in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    __main(sys.argv[1:])
@@ -2,6 +2,7 @@
 
 # adjust the size so the resulting compiled bin file is 11312 or more bytes
 size=24000
+project_name=CH559_verify_test
 
 
 if [ -z "$1" ]; then
@@ -14,9 +15,21 @@ if (( "$1" < 0 || "$1" > 255 )); then
 fi
 
 echo "Generating byte array of size $size bytes populated with $1"
-python3 scripts/gen_data.py -v "$1" -l $size -o test_array.h
-echo "Compiling test project ..."
-./build.sh -f usb.log
+# the cache leaves test_array.h untouched when size and value did not change
+python3 scripts/gen_data.py --cache --val "$1" -l $size -o test_array.h
+rebuild=0
+for src in test_array.h main.c *.h; do
+    if [ ! -f $project_name.bin ] || [ $src -nt $project_name.bin ]; then
+        rebuild=1
+    fi
+done
+if [ $rebuild == 1 ]; then
+    echo "Compiling test project ..."
+    ./build.sh -f usb.log
+else
+    echo "$project_name.bin is up to date, skipping compilation"
+    python3 scripts/chflasher.py --log=usb.log -w -f $project_name.bin
+fi
 
 
 
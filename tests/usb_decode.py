@@ -0,0 +1,202 @@
+# Protocol decoder for CH55x bootloader sessions
+# Turns a capture into structured records (command, length, address, payload, reply status),
+# removes the write/verify scrambling and rebuilds the firmware image the host sent,
+# which can be compared byte by byte with the original bin file.
+# Inputs: chflasher --log files, usb_parser output, Wireshark JSON exports or pcap/pcapng captures.
+# (c) 2020 by Piotr Zapart www.hexefx.com
+
+import sys
+import argparse
+from collections import namedtuple, Counter
+import usb_diff
+
+txt_sep = '--------------------------------------------------------------------------------'
+
+example_text = '''--------------------------------------------------------------------------------
+Example:
+
+ rebuild the written image and compare it with the bin file:
+
+ python3 usb_decode.py -i chflasher_usb.log --image sent.bin --bin CH559_verify_test.bin
+
+ list all decoded records:
+
+ python3 usb_decode.py -i usb.pcap -o records.txt
+
+ The scrambling key (byte x of the payload xored with key[x % 8]) is recovered from the
+ known plaintext with --bin, all 8 bytes of it, so the sessions of the WCH tool decode too.
+ Without --bin only key byte 7 (chflasher: chip id) is recovered from the remaining size
+ field, bytes 0-6 are taken as 0, the session has to reach the end of the image.
+ Every key command (a3) starts a new key, the WCH tool sends one before the write and one
+ before the verify. Use --key with 8 hex bytes to force one key for all frames,
+ --key 0000000000000000 for plain frames.
+'''
+
+FRAME_SIZE = 64
+Record = namedtuple('Record', 'command length address payload status')
+
+
+def __descramble(frames, key):
+    # frames: all write/verify frames back to back, byte x of each frame is xored with key[x % 8]
+    buf = bytearray(frames)
+    for i in range(8):
+        if key[i]:
+            buf[i::8] = buf[i::8].translate(bytes(x ^ key[i] for x in range(256)))
+    return buf
+
+
+def recover_key(pairs, frames, reference=None):
+    """
+    Key of the payload scrambling, payload byte x is xored with key[x % 8].
+    reference: the image that was sent, every key byte is the xor of a payload byte with its
+    plaintext, the most common value over all frames wins
+    Without reference only key byte 7 is recovered: byte 7 of a chflasher frame holds the remaining
+    image size, which is the payload length in the last frame, so the key byte is its xor with that.
+    Sessions without write/verify frames fall back to the chip id of the detect reply.
+    """
+    if frames and reference is not None:
+        votes = [Counter() for _ in range(8)]
+        for tx in frames:
+            addr = tx[3] | (tx[4] << 8)
+            for i in range(min(8, tx[1] - 5, len(tx) - 8, len(reference) - addr)):
+                votes[i][tx[8 + i] ^ reference[addr + i]] += 1
+        return bytes(v.most_common(1)[0][0] if v else 0 for v in votes)
+    if frames:
+        last = max(frames, key=lambda tx: tx[3] | (tx[4] << 8))
+        return bytes(7) + bytes((last[7] ^ ((last[1] - 5) & 0xff),))
+    for tx, rx in pairs:
+        if tx and tx[0] == 0xa1 and len(rx) == 6:
+            return bytes(7) + bytes((rx[4],))
+    return bytes(8)
+
+
+def decode(pairs, key=None, reference=None):
+    """
+    Records of the (tx, rx) pairs of one session, the a5/a6 payloads descrambled in one pass per key.
+    key: 8 byte scrambling key of all frames, None = recovered from the frames after every key command
+    reference: image the session sent, used for the key recovery
+    Returns (records, keys), one key per key command that was followed by write/verify frames.
+    """
+    pairs = list(pairs)
+    groups = [[]]
+    for tx, _ in pairs:
+        if tx and tx[0] == 0xa3 and groups[-1]:
+            groups.append([])
+        elif tx and tx[0] in (0xa5, 0xa6) and len(tx) >= 8:
+            groups[-1].append(tx)
+    keys = [key if key is not None else recover_key(pairs, frames, reference) for frames in groups]
+    plain = b''.join(__descramble(b''.join(bytes(tx).ljust(FRAME_SIZE, b'\0')[:FRAME_SIZE] for tx in frames), k)
+                     for frames, k in zip(groups, keys))
+    records = []
+    n = 0
+    for tx, rx in pairs:
+        if not tx:
+            continue
+        cmd = tx[0]
+        status = rx[4] if len(rx) > 4 else None
+        if cmd in (0xa5, 0xa6) and len(tx) >= 8:
+            frame = plain[n * FRAME_SIZE:(n + 1) * FRAME_SIZE]
+            n += 1
+            length = tx[1] - 5
+            records.append(Record(cmd, length, tx[3] | (tx[4] << 8), bytes(frame[8:8 + length]), status))
+        else:
+            records.append(Record(cmd, len(tx), None, bytes(tx[1:]), status))
+    return records, keys
+
+
+def rebuild_image(records, command, fill=0xff):
+    """ image assembled from the payloads of all write (0xa5) or verify (0xa6) records """
+    chunks = [r for r in records if r.command == command and r.address is not None]
+    if not chunks:
+        return b''
+    image = bytearray([fill]) * max(r.address + len(r.payload) for r in chunks)
+    for r in chunks:
+        image[r.address:r.address + len(r.payload)] = r.payload
+    return bytes(image)
+
+
+def compare_image(image, reference):
+    """ (first differing offset, number of differing bytes) over the common length, offset None = equal """
+    length = min(len(image), len(reference))
+    a = image[:length]
+    b = reference[:length]
+    if a == b:
+        return None, 0
+    x = (int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')).to_bytes(length, 'big')
+    count = length - x.count(0)
+    first = next(i for i in range(length) if x[i])
+    return first, count
+
+
+def print_records(records, out_file):
+    print(txt_sep, file=out_file)
+    print("cmd  len  addr    reply  payload", file=out_file)
+    print(txt_sep, file=out_file)
+    for r in records:
+        print('{:02x}  {:>4}  {:>6}  {:>5}  {}'.format(
+            r.command, r.length, '-' if r.address is None else '0x{:04x}'.format(r.address),
+            '-' if r.status is None else '{:02x}'.format(r.status), r.payload.hex(':')), file=out_file)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(prog='usb_decode',
+                                     description='Decoder for CH55x bootloader sessions.',
+                                     epilog=example_text,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-i', '--input', type=str, required=True, help="Log, parsed txt, JSON or pcap file.")
+    parser.add_argument('-o', '--output', type=str, default=None, help="Write the decoded records to a file.")
+    parser.add_argument('--key', type=bytes.fromhex, default=None, help="8 byte scrambling key as hex.")
+    parser.add_argument('--image', type=str, default=None, help="Save the rebuilt write image.")
+    parser.add_argument('--bin', type=str, default=None, help="Compare the rebuilt images with this bin file.")
+    parser.add_argument('--fill', type=lambda x: int(x, 0), default=0xff, help="Value of bytes never written.")
+    args = parser.parse_args()
+
+    if args.key is not None and len(args.key) != 8:
+        print("Error: the key has to be 8 bytes long")
+        sys.exit(2)
+
+    reference = None
+    if args.bin:
+        with open(args.bin, 'rb') as f:
+            reference = f.read()
+    records, keys = decode(usb_diff.pair_packets(usb_diff.load_packets(args.input)), args.key, reference)
+    written = rebuild_image(records, 0xa5, args.fill)
+    verified = rebuild_image(records, 0xa6, args.fill)
+    failed = [r for r in records if r.command == 0xa6 and r.status not in (None, 0x00, 0xfe)]
+
+    if args.output:
+        with open(args.output, 'w') as out_file:
+            print_records(records, out_file)
+        print("Records saved: " + args.output)
+    print(txt_sep)
+    print(str(len(records)) + " records, scrambling key " + ', '.join(k.hex(':') for k in keys))
+    if args.key is None and reference is None and any(r.address is not None for r in records):
+        print("Warning: without --bin only key byte 7 is recovered, bytes 0-6 are taken as 0,")
+        print("         the images are wrong if the host used a full 8 byte key (e.g. the WCH tool)")
+    print("Written image: " + str(len(written)) + " bytes, verified image: " + str(len(verified)) + " bytes")
+    if failed:
+        print("Verify failed in " + str(len(failed)) + " packets, first at " + '0x{:04x}'.format(failed[0].address))
+    if args.image:
+        with open(args.image, 'wb') as f:
+            f.write(written)
+        print("Image saved: " + args.image)
+    result = 0
+    if reference is not None:
+        for name, image in (("Written", written), ("Verified", verified)):
+            first, count = compare_image(image, reference)
+            if first is None:
+                print(name + " image matches " + args.bin + " in " + str(min(len(image), len(reference))) + " bytes")
+            else:
+                print(name + " image differs from " + args.bin + " in " + str(count) + " bytes, first at " +
+                      '0x{:04x}'.format(first))
+            # the WCH tool pads the last packet to a multiple of 8 bytes
+            padding = len(image) > len(reference) and len(image) % 8 == 0 and len(image) - len(reference) < 8
+            if padding:
+                print(name + " image has " + str(len(image) - len(reference)) + " padding byte(s) at the end")
+            elif len(image) != len(reference):
+                print(name + " image is " + str(len(image)) + " bytes, " + args.bin + " " + str(len(reference)))
+            if first is not None or (len(image) != len(reference) and not padding):
+                result = 1
+    print(txt_sep)
+    sys.exit(result)
@@ -0,0 +1,232 @@
+# Address aligned comparison of two CH55x flashing sessions
+# Sources can be chflasher --log files, usb_parser output, Wireshark JSON exports or pcap/pcapng captures.
+# Write/verify packets are indexed by command, flash address and pass (a packet sent again, e.g. by a
+# retry or a second verify, is a new pass), all other commands by their order,
+# then header fields, payload scrambling and reply codes are compared over the whole image at once.
+# (c) 2020 by Piotr Zapart www.hexefx.com
+
+import re
+import sys
+import argparse
+import usb_parser
+
+txt_sep = '--------------------------------------------------------------------------------'
+
+example_text = '''--------------------------------------------------------------------------------
+Example:
+
+ compare the chflasher log with the parsed WCH app capture:
+
+ python3 usb_diff.py -a chflasher_usb.log -b usb_dump_parsed.txt
+
+ exit code is 0 if both sessions sent and received the same, 1 otherwise
+'''
+
+FRAME_SIZE = 64
+frame_line = re.compile(r'^0x([0-9a-f]{4}):(?:OK |ERR)\|([0-9a-f]{2})\|([0-9a-f:]+)\s*$')
+data_line = re.compile(r'^(tx =|rx =|WR:|RD:)\s*([0-9a-f:]+)\s*$')
+
+
+class Session:
+    """
+    Packets of one flashing session.
+    frames      {(command, address, pass): (64 byte tx frame, reply status)} of the a5/a6 packets,
+                pass counts the earlier packets of the same command and address
+    commands    {(command, occurrence): (tx, rx)} of all other commands
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.frames = {}
+        self.commands = {}
+
+    def repeated(self):
+        """ number of write/verify packets sent again for an address """
+        return sum(1 for k in self.frames if k[2])
+
+    def add(self, tx, rx):
+        if not tx:
+            return
+        cmd = tx[0]
+        if cmd in (0xa5, 0xa6) and len(tx) >= 8:
+            status = rx[4] if len(rx) > 4 else None
+            addr = tx[3] | (tx[4] << 8)
+            n = 0
+            while (cmd, addr, n) in self.frames:
+                n += 1
+            self.frames[(cmd, addr, n)] = (bytes(tx).ljust(FRAME_SIZE, b'\0'), status)
+            return
+        n = 0
+        while (cmd, n) in self.commands:
+            n += 1
+        self.commands[(cmd, n)] = (bytes(tx), bytes(rx))
+
+
+def __hex_bytes(txt):
+    return bytes.fromhex(txt.replace(':', ''))
+
+
+def pair_packets(packets):
+    """ (tx, rx) pairs: every host packet is followed by the device reply, the exit command has none """
+    tx = None
+    for src, data in packets:
+        if src == "host":
+            if tx is not None:
+                yield tx, b''
+            tx = data
+        elif tx is not None:
+            yield tx, data
+            tx = None
+    if tx is not None:
+        yield tx, b''
+
+
+def __text_packets(lines):
+    # chflasher --log and usb_parser output
+    for line in lines:
+        m = frame_line.match(line)
+        if m:
+            tx = __hex_bytes(m.group(3))
+            yield "host", tx
+            # only the status byte of the reply is logged
+            yield "device", bytes((tx[0], 0, 2, 0, int(m.group(2), 16), 0))
+            continue
+        m = data_line.match(line)
+        if m:
+            src = "host" if m.group(1) in ("tx =", "WR:") else "device"
+            yield src, __hex_bytes(m.group(2))
+
+
+def load_packets(file_name):
+    """ (source, data) of every packet in a log, parsed txt, JSON export or pcap/pcapng file """
+    if usb_parser.is_pcap(file_name):
+        with open(file_name, 'rb') as f:
+            for src, data in usb_parser.iter_packets_pcap(f):
+                yield src, __hex_bytes(data)
+        return
+    with open(file_name, 'r') as f:
+        head = f.read(1)
+        f.seek(0)
+        if head == '[':
+            for src, data in usb_parser.iter_packets_stream(f):
+                yield src, __hex_bytes(data)
+        else:
+            for packet in __text_packets(f):
+                yield packet
+
+
+def load_session(file_name):
+    session = Session(file_name)
+    for tx, rx in pair_packets(load_packets(file_name)):
+        session.add(tx, rx)
+    return session
+
+
+def __xor_pattern(x):
+    # difference of two frames: 'key' when it repeats every 8 bytes, like a different scrambling key
+    payload = x[8:]
+    if payload[:8] * 7 == payload:
+        return 'scrambling key delta ' + payload[:8].hex(':')
+    return str(len(payload) - payload.count(0)) + ' payload bytes differ'
+
+
+def compare_frames(a, b):
+    """ differences of the write/verify frames, sorted by command, address and pass """
+    diffs = []
+    keys = sorted(set(a.frames) | set(b.frames))
+    common = [k for k in keys if k in a.frames and k in b.frames]
+    for k in keys:
+        if k not in a.frames:
+            diffs.append((k, 'only in ' + b.name))
+        elif k not in b.frames:
+            diffs.append((k, 'only in ' + a.name))
+    # the whole image in one buffer per session, xored in one go
+    buf_a = b''.join(a.frames[k][0] for k in common)
+    buf_b = b''.join(b.frames[k][0] for k in common)
+    if buf_a != buf_b:
+        x = (int.from_bytes(buf_a, 'big') ^ int.from_bytes(buf_b, 'big')).to_bytes(len(buf_a), 'big')
+        zero = bytes(FRAME_SIZE)
+        for i, k in enumerate(common):
+            fx = x[i * FRAME_SIZE:(i + 1) * FRAME_SIZE]
+            if fx == zero:
+                continue
+            if fx[0:7] != zero[0:7]:
+                fa = a.frames[k][0]
+                fb = b.frames[k][0]
+                diffs.append((k, 'header ' + fa[0:7].hex(':') + ' != ' + fb[0:7].hex(':')))
+            if fx[7:] != zero[7:]:
+                diffs.append((k, __xor_pattern(fx)))
+    status_a = bytes(0xff if a.frames[k][1] is None else a.frames[k][1] for k in common)
+    status_b = bytes(0xff if b.frames[k][1] is None else b.frames[k][1] for k in common)
+    if status_a != status_b:
+        for i, k in enumerate(common):
+            if status_a[i] != status_b[i]:
+                diffs.append((k, 'reply {:02x} != {:02x}'.format(status_a[i], status_b[i])))
+    diffs.sort(key=lambda d: d[0])
+    return diffs
+
+
+def compare_commands(a, b):
+    """ differences of the other commands, matched by command byte and occurrence """
+    diffs = []
+    for k in sorted(set(a.commands) | set(b.commands)):
+        if k not in a.commands:
+            diffs.append((k, 'only in ' + b.name))
+        elif k not in b.commands:
+            diffs.append((k, 'only in ' + a.name))
+        else:
+            tx_a, rx_a = a.commands[k]
+            tx_b, rx_b = b.commands[k]
+            if tx_a != tx_b:
+                diffs.append((k, 'tx ' + tx_a.hex(':') + ' != ' + tx_b.hex(':')))
+            if rx_a != rx_b:
+                diffs.append((k, 'rx ' + rx_a.hex(':') + ' != ' + rx_b.hex(':')))
+    return diffs
+
+
+def __pass(n):
+    return ' pass ' + str(n + 1) if n else ''
+
+
+def print_report(a, b, out_file):
+    commands = compare_commands(a, b)
+    frames = compare_frames(a, b)
+    print(txt_sep, file=out_file)
+    for label, s in (("A: ", a), ("B: ", b)):
+        print(label + s.name + " (" + str(len(s.frames)) + " write/verify packets, " + str(s.repeated()) +
+              " repeated)", file=out_file)
+    print(txt_sep, file=out_file)
+    if frames:
+        (cmd, addr, n), what = frames[0]
+        print("First divergence: {:02x} at 0x{:04x}{}: {}".format(cmd, addr, __pass(n), what), file=out_file)
+    print("Commands:", file=out_file)
+    for (cmd, n), what in commands:
+        print("  {:02x} #{}: {}".format(cmd, n, what), file=out_file)
+    print("Write/verify packets:", file=out_file)
+    for (cmd, addr, n), what in frames:
+        print("  {:02x} 0x{:04x}{}: {}".format(cmd, addr, __pass(n), what), file=out_file)
+    print(txt_sep, file=out_file)
+    print(str(len(commands)) + " command and " + str(len(frames)) + " packet differences", file=out_file)
+    return len(commands) + len(frames)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(prog='usb_diff',
+                                     description='Address aligned comparison of two CH55x flashing sessions.',
+                                     epilog=example_text,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-a', type=str, required=True, help="First session: log, parsed txt, JSON or pcap file.")
+    parser.add_argument('-b', type=str, required=True, help="Second session: log, parsed txt, JSON or pcap file.")
+    parser.add_argument('-o', '--output', type=str, default=None, help="Write the report to a file.")
+    args = parser.parse_args()
+
+    session_a = load_session(args.a)
+    session_b = load_session(args.b)
+    if args.output:
+        with open(args.output, 'w') as out_file:
+            differences = print_report(session_a, session_b, out_file)
+        print("Report saved: " + args.output)
+    else:
+        differences = print_report(session_a, session_b, sys.stdout)
+    sys.exit(1 if differences else 0)
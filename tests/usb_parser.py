@@ -1,9 +1,25 @@
 # Parser for the CH559 usb data sniffed with the Wireshark and exported to JSON
 # script will format and comment the transactions
+# pcap/pcapng captures (Linux usbmon or Windows USBPcap) can be read directly too
 # (c) 2020 by Piotr Zapart www.hexefx.com
 
 import json
 import argparse
+import mmap
+import struct
+# pcap magic -> byte order
+PCAP_MAGIC = {
+    b'\xd4\xc3\xb2\xa1': '<',
+    b'\xa1\xb2\xc3\xd4': '>',
+    b'\x4d\x3c\xb2\xa1': '<',    # nanosecond timestamps
+    b'\xa1\xb2\x3c\x4d': '>',
+}
+PCAPNG_MAGIC = b'\x0a\x0d\x0d\x0a'
+LINKTYPE_USB_LINUX = 189
+LINKTYPE_USB_LINUX_MMAPPED = 220
+LINKTYPE_USBPCAP = 249
+USB_TRANSFER_BULK = 3
+
 txt_sep = '--------------------------------------------------------------------------------'
 
 example_text = '''--------------------------------------------------------------------------------
@@ -13,6 +29,19 @@ How to generate input data:
  File/Export Packet Dissections/As JSON option.
  Use the exported JSON data as the input file:
  python3 usb_parser.py -i USB_data.json -o USB_log.txt
+
+ Long captures can be parsed with constant memory use, packets are
+ read one by one and written out as they come:
+ python3 usb_parser.py --stream -i USB_data.json -o USB_log.txt
+
+ The JSON export step can be skipped, usbmon (Linux) and USBPcap (Windows)
+ captures in pcap or pcapng format are detected and read directly:
+ python3 usb_parser.py -i USB_data.pcapng -o USB_log.txt
+
+ Only the transfers of the CH55x are kept: the device the detect command (a1/a2)
+ is sent to, or the one given with --device BUS.DEV (e.g. 1.7), other devices
+ on a captured bus (storage, serial adapters) are dropped:
+ python3 usb_parser.py -i usbmon1.pcap -o USB_log.txt --device 1.7
 '''
 
 
@@ -26,20 +55,220 @@ def usage():
     print("")
 
 
-def print_title(title, addr_rng):
+def print_title(title, addr_rng, out_file):
     print(txt_sep, file=out_file)
     print(title, file=out_file)
     print("add=" + '|'.join('{:02x}'.format(x) for x in range(addr_rng)), file=out_file)
 
 
+def __packet_fields(packet):
+    # (source, capdata) of one exported packet, None for packets without payload
+    layers = packet["_source"]["layers"]
+    if "usb.capdata" not in layers:
+        return None
+    return layers["usb"]["usb.src"], layers["usb.capdata"]
+
+
+def iter_packets(f):
+    """ packets of the whole JSON export, loaded at once """
+    for packet in json.load(f):
+        fields = __packet_fields(packet)
+        if fields is not None:
+            yield fields
+
+
+def iter_packets_stream(f, chunk_size=1 << 16):
+    """ packets of the JSON export decoded one by one from the top level array, memory use stays constant """
+    decoder = json.JSONDecoder()
+    buf = ''
+    eof = False
+    in_array = False
+    while True:
+        buf = buf.lstrip(' \t\r\n,')
+        if not buf:
+            if eof:
+                return
+            buf = f.read(chunk_size)
+            eof = not buf
+            continue
+        if not in_array:
+            if buf[0] != '[':
+                raise ValueError('Input is not a JSON array of packets')
+            in_array = True
+            buf = buf[1:]
+            continue
+        if buf[0] == ']':
+            return
+        try:
+            packet, end = decoder.raw_decode(buf)
+        except ValueError:
+            if eof:
+                raise
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buf += chunk
+            continue
+        buf = buf[end:]
+        fields = __packet_fields(packet)
+        if fields is not None:
+            yield fields
+
+
+def __usb_fields(linktype, data):
+    # ((bus, device), source, payload) of a bulk transfer with payload, None for everything else
+    if linktype in (LINKTYPE_USB_LINUX, LINKTYPE_USB_LINUX_MMAPPED):
+        header_len = 48 if linktype == LINKTYPE_USB_LINUX else 64
+        if len(data) <= header_len or data[9] != USB_TRANSFER_BULK:
+            return None
+        endpoint = data[10]
+        device = data[11]
+        bus = struct.unpack_from('<H', data, 12)[0]
+        payload = data[header_len:]
+        from_device = endpoint & 0x80
+    elif linktype == LINKTYPE_USBPCAP:
+        header_len = struct.unpack_from('<H', data, 0)[0]
+        if len(data) <= header_len or data[22] != USB_TRANSFER_BULK:
+            return None
+        bus, device = struct.unpack_from('<HH', data, 17)
+        endpoint = data[21]
+        payload = data[header_len:]
+        from_device = data[16] & 0x01
+    else:
+        return None
+    if from_device:
+        src = '{}.{}.{}'.format(bus, device, endpoint & 0x7f)
+    else:
+        src = "host"
+    return (bus, device), src, payload
+
+
+def __pcap_records(buf):
+    endian = PCAP_MAGIC[buf[0:4]]
+    linktype = struct.unpack_from(endian + 'I', buf, 20)[0]
+    pos = 24
+    while pos + 16 <= len(buf):
+        incl_len = struct.unpack_from(endian + 'I', buf, pos + 8)[0]
+        yield linktype, buf[pos + 16:pos + 16 + incl_len]
+        pos += 16 + incl_len
+
+
+def __pcapng_records(buf):
+    endian = '<'
+    linktypes = []
+    pos = 0
+    while pos + 12 <= len(buf):
+        if buf[pos:pos + 4] == PCAPNG_MAGIC:
+            # section header, sets the byte order of the following blocks
+            endian = '<' if buf[pos + 8:pos + 12] == b'\x4d\x3c\x2b\x1a' else '>'
+            linktypes = []
+        block_type, block_len = struct.unpack_from(endian + 'II', buf, pos)
+        if block_len < 12:
+            raise ValueError('Corrupt pcapng block at offset ' + str(pos))
+        if block_type == 1:
+            linktypes.append(struct.unpack_from(endian + 'H', buf, pos + 8)[0])
+        elif block_type == 6:
+            interface, _, _, cap_len = struct.unpack_from(endian + 'IIII', buf, pos + 8)
+            yield linktypes[interface], buf[pos + 28:pos + 28 + cap_len]
+        elif block_type == 3:
+            orig_len = struct.unpack_from(endian + 'I', buf, pos + 8)[0]
+            yield linktypes[0], buf[pos + 12:pos + 12 + min(orig_len, block_len - 16)]
+        pos += block_len
+
+
+def is_pcap(file_name):
+    with open(file_name, 'rb') as f:
+        magic = f.read(4)
+    return magic in PCAP_MAGIC or magic == PCAPNG_MAGIC
+
+
+def __records(buf):
+    if buf[0:4] == PCAPNG_MAGIC:
+        return __pcapng_records(buf)
+    return __pcap_records(buf)
+
+
+def find_device(buf):
+    """ (bus, device) the first CH55x detect command (a1/a2 with the ISP string) was sent to, None if there is none """
+    for linktype, data in __records(buf):
+        fields = __usb_fields(linktype, data)
+        if fields is not None:
+            address, src, payload = fields
+            if src == "host" and payload[0] in (0xa1, 0xa2) and b' ISP' in payload:
+                return address
+    return None
+
+
+def parse_device(txt):
+    """ BUS.DEV of the --device option as (bus, device) """
+    try:
+        bus, device = (int(x) for x in txt.split('.'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('device must be BUS.DEV, e.g. 1.7')
+    return bus, device
+
+
+def iter_packets_pcap(f, device=None):
+    """
+    bulk transfers of a usbmon or USBPcap capture in pcap or pcapng format, the file is memory mapped
+    device: (bus, device) to keep, None = the device of the first detect command, all of them if the
+    capture has none
+    """
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        if device is None:
+            device = find_device(buf)
+        for linktype, data in __records(buf):
+            fields = __usb_fields(linktype, data)
+            if fields is not None and (device is None or fields[0] == device):
+                yield fields[1], fields[2].hex(':')
+
+
+def parse(packets, out_file):
+    """ writes the (source, capdata) packets with the detected commands as titles """
+    write_once = False
+    verify_once = False
+    for src, data in packets:
+        if src == "host":
+            oper = "WR: "
+        else:
+            oper = "RD: "
+
+        if oper == "WR: ":
+            if data[0:2] == 'a1':
+                print_title("Detect sequence:", 0x15, out_file)
+            elif data[0:2] == 'a2':
+                print_title("Reset and run application:", 0x06, out_file)
+            elif data[0:2] == 'a7':
+                print_title("Read config data:", 0x1E, out_file)
+            elif data[0:2] == 'a8':
+                print_title("Write config data:", 0x11, out_file)
+            elif data[0:2] == 'a3':
+                print_title("Send key:", 0x3E, out_file)
+            elif data[0:2] == 'a4':
+                print_title("Erase chip:", 0x06, out_file)
+            elif data[0:2] == 'a5' and write_once is False:
+                print_title("Write flash", 0x40, out_file)
+                write_once = True
+            elif data[0:2] == 'a6' and verify_once is False:
+                print_title("Verify flash", 0x40, out_file)
+                verify_once = True
+        print(oper, file=out_file, end='')
+        print(data, file=out_file)
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(prog='usb_parser',
                                      description='Parser for the CH55x USB data packets in json format.',
                                      epilog=example_text,
                                      formatter_class=argparse.RawDescriptionHelpFormatter)
-    parser.add_argument('-i', '--input', type=str, default='', required=True, help="Input JSON file.")
+    parser.add_argument('-i', '--input', type=str, default='', required=True,
+                        help="Input JSON export or pcap/pcapng capture.")
     parser.add_argument('-o', '--output', type=str, default='', required=True, help="Parsed output txt file.")
+    parser.add_argument('--stream', action='store_true', default=False,
+                        help="Decode the input packet by packet with constant memory use.")
+    parser.add_argument('--device', type=parse_device, default=None,
+                        help="pcap/pcapng: keep only the transfers of device BUS.DEV "
+                             "(default: the device the detect command is sent to).")
     args = parser.parse_args()
 
     input_file = None
@@ -50,40 +279,13 @@ if __name__ == "__main__":
     if args.output:
         output_file = args.output
 
-    with open(input_file, 'r') as f:
-        usb_data = json.load(f)
-    
-    write_once = False
-    verify_once = False
-
-    with open(output_file, 'w') as out_file:
-        for key in usb_data:
-            if key["_source"]["layers"]["usb"]["usb.src"] == "host":
-                oper = "WR: "
+    if is_pcap(input_file):
+        with open(input_file, 'rb') as f, open(output_file, 'w') as out_file:
+            parse(iter_packets_pcap(f, args.device), out_file)
+    else:
+        with open(input_file, 'r') as f, open(output_file, 'w') as out_file:
+            if args.stream:
+                parse(iter_packets_stream(f), out_file)
             else:
-                oper = "RD: "
-            data = key["_source"]["layers"]["usb.capdata"]
-
-            if oper == "WR: ":
-                if data[0:2] == 'a1':
-                    print_title("Detect sequence:", 0x15)
-                elif data[0:2] == 'a2':
-                    print_title("Reset and run application:", 0x06)
-                elif data[0:2] == 'a7':
-                    print_title("Read config data:", 0x1E)
-                elif data[0:2] == 'a8':
-                    print_title("Write config data:", 0x11)
-                elif data[0:2] == 'a3':
-                    print_title("Send key:", 0x3E)
-                elif data[0:2] == 'a4':
-                    print_title("Erase chip:", 0x06)
-                elif data[0:2] == 'a5' and write_once is False:
-                    print_title("Write flash", 0x40)
-                    write_once = True
-                elif data[0:2] == 'a6' and verify_once is False:
-                    print_title("Verify flash", 0x40)
-                    verify_once = True
-            print(oper, file=out_file, end='')
-            print(key["_source"]["layers"]["usb.capdata"], file=out_file)
-        print("Log file saved: " + output_file)
-
+                parse(iter_packets(f), out_file)
+    print("Log file saved: " + output_file)